@@ -3,42 +3,68 @@ import os
 import sys
 import argparse
 import subprocess
-import xattr
+from mergerfs import find_mountpoint, list_mergerfs
 import re
 import hashlib
+import concurrent.futures
+import collections
+import sqlite3
+import json
+import shutil
+import threading
+import time
+import contextlib
+import itertools
 
 
 RED='\033[0;31m'
 NC='\033[0m'
 
-def find_mountpoint(path):
-    mountpoint=subprocess.run(['stat', '-c', '%m', '--', path],stdout=subprocess.PIPE, shell=False, check=True).stdout.decode('utf8').replace('\n', '').replace('\r', '')
-    return mountpoint
-
-def list_mergerfs():
-    mergerfs=re.compile(r'^[^ ]* (.*) fuse\.mergerfs.*')
-    sanitize=re.compile(r'=[^:]*')
-    mountpoint={}
-    with open('/proc/mounts','r') as mounts:
-        for line in mounts.read().splitlines():
-            (point, match)=re.subn(mergerfs,'\g<1>',line)
-            if match==1:
-                mountpoint[point]=re.sub(sanitize,'',xattr.get(os.path.join(point,'.mergerfs'),'user.mergerfs.branches').decode('utf-8')).split(':')
-    return mountpoint
-
-
-def dir_size(start_path):
-    total_size = 0
-    for element in os.listdir(start_path):
-        pathname=os.path.join(start_path, element)
-        #skip links and mountpoints, recurse dirs
-        if not os.path.islink(pathname):
-            if os.path.isfile(pathname):
-                total_size += os.path.getsize(pathname)
-            elif os.path.isdir(pathname): 
-                if not os.path.ismount(pathname):
-                    total_size += dir_size(pathname)
-    return total_size
+def scan_branch(start_path):
+    """
+    Walks a branch directly (not through the mergerfs mount) with os.scandir.
+    Links and mountpoints are skipped, like dir_size used to do.
+    Returns:
+        dict of path relative to start_path: (size, device, inode) for every file
+    """
+    found={}
+    device=os.stat(start_path).st_dev
+    pending=['']
+    while pending:
+        relative_dir=pending.pop()
+        for entry in os.scandir(os.path.join(start_path, relative_dir)):
+            relative=os.path.join(relative_dir, entry.name)
+            if entry.is_symlink():
+                continue
+            if entry.is_file(follow_symlinks=False):
+                stat=entry.stat(follow_symlinks=False)
+                found[relative]=(stat.st_size, stat.st_dev, stat.st_ino)
+            elif entry.is_dir(follow_symlinks=False):
+                if entry.stat(follow_symlinks=False).st_dev == device:
+                    pending.append(relative)
+    return found
+
+def scan_target(source):
+    """
+    Scans every branch of a target in parallel (each branch is a different disk)
+    and derives everything the consolidation needs from that single pass.
+    Sets branchsize on every branch in source.
+    Returns:
+        size of the target as seen through mergerfs (one copy per path, from the
+        first branch that has it), and the collisions: list of lists of the
+        full paths of every file present in more than one branch, or None
+    """
+    branches=[i for i in source if i['isbranch']]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(branches))) as executor:
+        scans=list(executor.map(scan_branch, [i['branchpath'] for i in branches]))
+    copies={}
+    for branch, scan in zip(branches, scans):
+        branch['branchsize']=sum(size for size, device, inode in scan.values())
+        for relative, (size, device, inode) in scan.items():
+            copies.setdefault(relative, []).append((os.path.join(branch['branchpath'], relative), size))
+    targetsize=sum(paths[0][1] for paths in copies.values())
+    collisions=[[path for path, size in paths] for paths in copies.values() if len(paths) > 1]
+    return targetsize, (collisions if len(collisions) > 0 else None)
 
 units = {None: 1, "B": 1, "KB": 2**10, "MB": 2**20, "GB": 2**30, "TB": 2**40}
 
@@ -49,174 +75,849 @@ def parse_size(size):
     number, unit = [string.strip() for string in size.split()]
     return int(float(number)*units[unit])
 
-def md5sum(file):
+BLOCK_SIZE=2**20
+
+def md5sum(file, throttle=None):
     md5_hash=hashlib.md5()
     with open (file,'rb') as f:
-        for byte_block in iter(lambda: f.read(4096),b""):
+        for byte_block in iter(lambda: f.read(BLOCK_SIZE),b""):
             md5_hash.update(byte_block)
+            if throttle is not None:
+                throttle(len(byte_block))
         return(md5_hash.hexdigest())
 
-def find_file_collisions(path):
+def head_tail_md5sum(file, throttle=None):
+    """
+    md5 of the first and last BLOCK_SIZE bytes of the file. For files up to
+    2*BLOCK_SIZE that is the whole file, so it is the same as md5sum.
+    """
+    md5_hash=hashlib.md5()
+    with open (file,'rb') as f:
+        size=os.fstat(f.fileno()).st_size
+        if size <= 2*BLOCK_SIZE:
+            md5_hash.update(f.read())
+        else:
+            md5_hash.update(f.read(BLOCK_SIZE))
+            f.seek(size-BLOCK_SIZE)
+            md5_hash.update(f.read(BLOCK_SIZE))
+        if throttle is not None:
+            throttle(min(size, 2*BLOCK_SIZE))
+        return(md5_hash.hexdigest())
+
+def default_cache():
+    return os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'consolidate', 'hashes.sqlite')
+
+def open_cache(cache_file):
+    """
+    Opens (creating it if needed) the hash cache, so a rerun after an aborted
+    consolidation does not hash the same files again. Hashes are keyed by the
+    identity of the file (device, inode, size, mtime), any change is a miss.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(cache_file)), exist_ok=True)
+    cache_db=sqlite3.connect(cache_file, timeout=60)
+    cache_db.execute("""
+    CREATE TABLE IF NOT EXISTS hashes (
+        device INTEGER, inode INTEGER, size INTEGER, mtime INTEGER, kind TEXT, md5 TEXT,
+        PRIMARY KEY (device, inode, size, mtime, kind)
+    );
+    """)
+    return cache_db
+
+def file_key(file):
+    stat=os.stat(file)
+    return (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+def stage_hashes(paths, kind, keys, executor, cache_db, counters, scheduler):
+    """
+    Hashes paths with md5sum (kind 'full') or head_tail_md5sum (kind
+    'partial'), all of them at the same time since every copy is on a
+    different branch, i.e. a different disk, within the limits of the
+    scheduler for that disk. Hashes in the cache are not computed again.
+    Returns:
+        dict of path: hash
+    """
+    hashes={}
+    for path in paths:
+        if cache_db is not None:
+            row=cache_db.execute("SELECT md5 FROM hashes WHERE device=? AND inode=? AND size=? AND mtime=? AND kind=?;", keys[path]+(kind,)).fetchone()
+            if row:
+                hashes[path]=row[0]
+                counters['cached']+=keys[path][2] if kind == 'full' else min(keys[path][2], 2*BLOCK_SIZE)
+    function=md5sum if kind == 'full' else head_tail_md5sum
+    def hash_file(path):
+        with scheduler.slot(keys[path][0]):
+            return function(path, scheduler.throttler(keys[path][0]))
+    futures={path: executor.submit(hash_file, path) for path in paths if path not in hashes}
+    for path, future in futures.items():
+        hashes[path]=future.result()
+        counters['hashed']+=keys[path][2] if kind == 'full' else min(keys[path][2], 2*BLOCK_SIZE)
+    if cache_db is not None and futures:
+        with cache_db:
+            cache_db.executemany("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?);", [keys[path]+(kind, hashes[path]) for path in futures])
+    return hashes
+
+def compare_copies(paths, executor, cache_db, counters, scheduler):
+    """
+    Compares every copy of a colliding file against the first one, in stages
+    that get more expensive: size first, then the head and tail of the files,
+    and only the copies still matching get a full hash.
+    Returns:
+        list of the copies identical to the first one, list of the copies that
+        differ, and dict of path: the last hash computed for it (if any)
+    """
+    keys={path: file_key(path) for path in paths}
+    counters['total']+=sum(key[2] for key in keys.values())
+    size=keys[paths[0]][2]
+    candidates=[path for path in paths if keys[path][2] == size]
+    different=[path for path in paths if keys[path][2] != size]
+    counters['skipped']+=sum(keys[path][2] for path in different)
+    hashes={}
+    #bytes of every remaining candidate read by the stages run so far
+    read=0
+    for kind in ('partial', 'full'):
+        #the partial hash of a small file already covers all of it
+        if len(candidates) < 2 or (kind == 'full' and size <= 2*BLOCK_SIZE):
+            break
+        hashes.update(stage_hashes(candidates, kind, keys, executor, cache_db, counters, scheduler))
+        read=size if kind == 'full' else min(size, 2*BLOCK_SIZE)
+        mismatch=[path for path in candidates if hashes[path] != hashes[paths[0]]]
+        counters['skipped']+=len(mismatch)*(size-read)
+        different+=mismatch
+        candidates=[path for path in candidates if hashes[path] == hashes[paths[0]]]
+    counters['skipped']+=len(candidates)*(size-read)
+    return candidates[1:], different, hashes
+
+def rsync_branch(branchpath, destination, dryrun):
+    #print('rsync -aPx --dry-run --ignore-existing --remove-source-files ' + os.path.join(branchpath)+' '+ destination)
+    #print('find '+ os.path.join(branchpath) + ' -type d -empty -delete ')
+    if dryrun:
+        try:
+            rsync_command_dryrun=['rsync', '-a', '-P', '-x', '-i', '--ignore-existing', '--remove-source-files', '--dry-run', os.path.join(branchpath), destination]
+            find_clean_command_dryrun=['find', os.path.join(branchpath), '-type', 'd', '-empty' ]
+            print("Moving (dry run)... "+os.path.join(branchpath)+' -> '+ destination)
+            rsync_process=subprocess.run(rsync_command_dryrun, stdin=None, shell=False, check=True)
+            print("Deleting empty folders (dry run)... "+os.path.join(branchpath))
+            find_clean_process=subprocess.run(find_clean_command_dryrun, stdin=None, shell=False, check=True)
+            #print(f)
+        except subprocess.CalledProcessError as e:
+            print(e.output)
+            print(e.returncode)
+    else:
+        try:
+            rsync_command=['rsync', '-a', '-P', '-x', '--ignore-existing', '--remove-source-files', os.path.join(branchpath), destination]
+            find_clean_command=['find', os.path.join(branchpath), '-type', 'd', '-empty', '-delete' ]
+            print("Moving... "+os.path.join(branchpath)+' -> '+ destination)
+            rsync_process=subprocess.run(rsync_command, stdin=None, shell=False, check=True)
+            print("Deleting empty folders... "+os.path.join(branchpath))
+            find_clean_process=subprocess.run(find_clean_command, stdin=None, shell=False, check=True)
+            #print(f)
+        except subprocess.CalledProcessError as e:
+            print(e.output)
+            print(e.returncode)
+
+class DiskScheduler:
+    """
+    Keeps the I/O of the consolidation within per disk limits, so the pool can
+    keep serving its readers: at most jobs reads/writes at a time on each disk
+    (0: no limit) and at most rate bytes per second on each disk (0: no limit),
+    reads and writes together. Disks are told apart by device, every branch
+    being a different one. Shared by all the worker threads.
+    """
+    def __init__(self, jobs=0, rate=0):
+        self.jobs=jobs
+        self.rate=rate
+        self.lock=threading.Lock()
+        self.slots={}
+        self.ready={}
+
+    @contextlib.contextmanager
+    def slot(self, *devices):
+        """
+        Holds one of the jobs slots of every device given while the block
+        runs. Always taken in the same order, so two workers needing the same
+        two disks cannot deadlock.
+        """
+        devices=sorted(set(devices))
+        semaphores=[]
+        if self.jobs > 0:
+            with self.lock:
+                for device in devices:
+                    if device not in self.slots:
+                        self.slots[device]=threading.Semaphore(self.jobs)
+                    semaphores.append(self.slots[device])
+        for semaphore in semaphores:
+            semaphore.acquire()
+        try:
+            yield
+        finally:
+            for semaphore in reversed(semaphores):
+                semaphore.release()
+
+    def throttle(self, devices, size):
+        """
+        Charges size bytes to every device given and sleeps for as long as it
+        takes to bring each of them back under rate.
+        """
+        now=time.time()
+        wait=0
+        with self.lock:
+            for device in devices:
+                self.ready[device]=max(now, self.ready.get(device, now)) + size/self.rate
+                wait=max(wait, self.ready[device] - now)
+        if wait > 0:
+            time.sleep(wait)
+
+    def throttler(self, *devices):
+        """
+        Returns:
+            the callback for md5sum and copy_data, charging the devices
+            given, or None when there is no rate limit
+        """
+        if self.rate <= 0:
+            return None
+        return lambda size: self.throttle(devices, size)
+
+class Progress:
+    """
+    Aggregate progress of the move workers, shared between threads.
+    """
+    def __init__(self):
+        self.lock=threading.Lock()
+        self.start=time.time()
+        self.files=0
+        self.bytes=0
+
+    def moved(self, source, destination, size):
+        with self.lock:
+            self.files+=1
+            self.bytes+=size
+            elapsed=max(time.time()-self.start, 0.001)
+            print('Moved '+source+' -> '+destination+' ('+str(size)+' bytes) ['+str(self.files)+' files, '+format(self.bytes/2**20, '.1f')+' MB, '+format(self.bytes/2**20/elapsed, '.1f')+' MB/s]')
+
+    def summary(self):
+        elapsed=max(time.time()-self.start, 0.001)
+        print('Moved '+str(self.files)+' files, '+str(self.bytes)+' bytes in '+format(elapsed, '.1f')+'s ('+format(self.bytes/2**20/elapsed, '.1f')+' MB/s)')
+
+def copy_data(source_fd, destination_fd, size, throttle=None):
+    """
+    Copies size bytes between two file descriptors inside the kernel when
+    possible: copy_file_range (python 3.8+), then sendfile, then plain reads.
+    With a throttle, the copy goes in small chunks and each one is charged.
+    """
+    copied=0
+    chunk=2**30 if throttle is None else 8*BLOCK_SIZE
+    if throttle is None:
+        throttle=lambda count: None
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while copied < size:
+                count=os.copy_file_range(source_fd, destination_fd, min(size-copied, chunk))
+                if count == 0:
+                    break
+                copied+=count
+                throttle(count)
+            return copied
+        except OSError:
+            #e.g. EXDEV on older kernels, carry on with sendfile
+            pass
+    try:
+        while copied < size:
+            count=os.sendfile(destination_fd, source_fd, copied, min(size-copied, chunk))
+            if count == 0:
+                break
+            copied+=count
+            throttle(count)
+        return copied
+    except OSError:
+        pass
+    os.lseek(source_fd, copied, os.SEEK_SET)
+    os.lseek(destination_fd, copied, os.SEEK_SET)
+    while copied < size:
+        block=os.read(source_fd, BLOCK_SIZE)
+        if not block:
+            break
+        os.write(destination_fd, block)
+        copied+=len(block)
+        throttle(len(block))
+    return copied
+
+def copy_metadata(source, destination, stat):
+    #permissions, times and xattrs, then the owner when allowed (like rsync -a as root)
+    shutil.copystat(source, destination, follow_symlinks=False)
+    #times as they were in stat, the source may have changed since (a
+    #directory being emptied)
+    os.utime(destination, ns=(stat.st_atime_ns, stat.st_mtime_ns), follow_symlinks=False)
+    try:
+        os.chown(destination, stat.st_uid, stat.st_gid, follow_symlinks=False)
+    except (PermissionError, NotImplementedError):
+        pass
+
+NAME_MAX=255
+temporaries=itertools.count()
+
+def temporary_name(destination):
+    #hidden and unique, with the name of the file cut down to fit NAME_MAX (like rsync)
+    suffix='.consolidate-'+str(os.getpid())+'-'+str(next(temporaries))
+    name=os.fsencode(os.path.basename(destination))
+    limit=NAME_MAX-1-len(suffix)
+    if len(name) > limit:
+        #not in the middle of a utf-8 character
+        while limit and name[limit] & 0xc0 == 0x80:
+            limit-=1
+        name=name[:limit]
+    return os.path.join(os.path.dirname(destination), '.'+os.fsdecode(name)+suffix)
+
+def move_file(source, destination, verify=False, journal=None, throttle=None):
+    """
+    Copies a file next to its destination under a temporary name, checks it
+    and only then links it into place and removes the source. Existing files
+    at the destination are never overwritten (like rsync --ignore-existing),
+    and the source is kept in that case. Every step is recorded in the
+    journal, if any, so an interrupted move can be finished by Journal.recover.
+    Returns:
+        number of bytes moved, or None if the file was not moved
+    """
+    stat=os.lstat(source)
+    temporary=temporary_name(destination)
+    if os.path.lexists(destination):
+        return None
+    if journal is not None:
+        journal.file_state(source, destination, temporary, stat.st_size, 'copying')
+    if os.path.islink(source):
+        os.symlink(os.readlink(source), temporary)
+    else:
+        with open(source, 'rb') as source_file, open(temporary, 'wb') as destination_file:
+            copied=copy_data(source_file.fileno(), destination_file.fileno(), stat.st_size, throttle)
+            destination_file.flush()
+            os.fsync(destination_file.fileno())
+        if copied != stat.st_size or os.stat(temporary).st_size != stat.st_size or (verify and md5sum(source, throttle) != md5sum(temporary, throttle)):
+            print('Verification failed, keeping the source: '+source)
+            os.remove(temporary)
+            if journal is not None:
+                journal.file_state(source, destination, temporary, stat.st_size, 'failed')
+            return None
+    copy_metadata(source, temporary, stat)
+    try:
+        #link fails if something appeared at the destination in the meantime
+        os.link(temporary, destination, follow_symlinks=False)
+    except FileExistsError:
+        os.remove(temporary)
+        if journal is not None:
+            journal.file_state(source, destination, temporary, stat.st_size, 'exists')
+        return None
+    if journal is not None:
+        journal.file_state(source, destination, temporary, stat.st_size, 'linked')
+    os.remove(temporary)
+    os.remove(source)
+    if journal is not None:
+        journal.file_state(source, destination, temporary, stat.st_size, 'done')
+    return stat.st_size
+
+def move_branch(branchpath, target, dryrun=False, verify=False, progress=None, journal=None, scheduler=None):
+    """
+    Native replacement for rsync -ax --ignore-existing --remove-source-files
+    plus find -empty -delete: moves everything in branchpath into target (on
+    another branch), without crossing filesystems, then prunes the empty
+    directories left behind. Up to scheduler.jobs files are moved at a time,
+    each one holding a slot of both disks.
+    """
+    if scheduler is None:
+        scheduler=DiskScheduler()
+    device=os.stat(branchpath).st_dev
+    target_device=None if dryrun else os.stat(target).st_dev
+    directories=[]
+    #directories created in target, with the stat of their source
+    created={}
+    pending=['']
+    workers=max(1, scheduler.jobs)
+    executor=concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    window=collections.deque()
+
+    def move(source, destination):
+        with scheduler.slot(device, target_device):
+            size=move_file(source, destination, verify, journal, scheduler.throttler(device, target_device))
+        if size is not None and progress is not None:
+            progress.moved(source, destination, size)
+
+    while pending:
+        relative_dir=pending.pop()
+        source_dir=os.path.join(branchpath, relative_dir)
+        destination_dir=os.path.join(target, relative_dir)
+        directories.append(relative_dir)
+        if not dryrun:
+            if not os.path.isdir(destination_dir):
+                created[relative_dir]=os.stat(source_dir)
+                os.makedirs(destination_dir, exist_ok=True)
+        for entry in os.scandir(source_dir):
+            relative=os.path.join(relative_dir, entry.name)
+            if entry.is_dir(follow_symlinks=False):
+                if entry.stat(follow_symlinks=False).st_dev == device:
+                    pending.append(relative)
+            elif entry.is_file(follow_symlinks=False) or entry.is_symlink():
+                if dryrun:
+                    if not os.path.lexists(os.path.join(target, relative)):
+                        print('Moving (dry run)... '+entry.path+' -> '+os.path.join(target, relative))
+                    continue
+                #bounded, a branch can hold millions of files
+                if len(window) >= 2*workers:
+                    window.popleft().result()
+                window.append(executor.submit(move, entry.path, os.path.join(target, relative)))
+            else:
+                print('Skipping special file '+entry.path)
+    while window:
+        window.popleft().result()
+    executor.shutdown()
+    #deepest first, so parents are empty by the time they are checked, and
+    #the metadata of new directories is set once nothing is linked into them
+    for relative_dir in reversed(directories):
+        source_dir=os.path.join(branchpath, relative_dir)
+        if relative_dir in created:
+            copy_metadata(source_dir, os.path.join(target, relative_dir), created[relative_dir])
+        if not os.listdir(source_dir):
+            if dryrun:
+                print('Deleting empty folder (dry run)... '+source_dir)
+            else:
+                os.rmdir(source_dir)
+
+def default_journal():
+    return os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'consolidate', 'journal.sqlite')
+
+class Journal:
+    """
+    Crash-safe record of a consolidation run: the plan, how far every target
+    got (planned, deduped, moved) and the state of every file move (copying,
+    linked, done, or failed/exists when the source was kept). Every change is
+    committed before the step it describes goes on, so after a crash --resume
+    knows what is finished without rescanning and which moves were cut short.
+    Shared by the mover threads.
+    """
+    def __init__(self, journal_file):
+        os.makedirs(os.path.dirname(os.path.abspath(journal_file)), exist_ok=True)
+        self.lock=threading.Lock()
+        self.db=sqlite3.connect(journal_file, timeout=60, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        #commits are not synced to disk one by one; WAL keeps it consistent,
+        #a power cut only loses the last steps, which recover handles anyway
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS plan (id INTEGER PRIMARY KEY CHECK (id = 0), plan TEXT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS targets (target TEXT PRIMARY KEY, state TEXT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS files (source TEXT PRIMARY KEY, destination TEXT, temporary TEXT, size INTEGER, state TEXT)")
+        self.db.commit()
+
+    def start(self, plan):
+        with self.lock:
+            self.db.execute("DELETE FROM plan")
+            self.db.execute("DELETE FROM targets")
+            self.db.execute("DELETE FROM files")
+            self.db.execute("INSERT INTO plan VALUES (0, ?)", (json.dumps(plan),))
+            self.db.executemany("INSERT INTO targets VALUES (?, 'planned')", [(entry['target'],) for entry in plan['targets']])
+            self.db.commit()
+
+    def load(self):
+        with self.lock:
+            row=self.db.execute("SELECT plan FROM plan").fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def state(self, target):
+        with self.lock:
+            row=self.db.execute("SELECT state FROM targets WHERE target = ?", (target,)).fetchone()
+        return None if row is None else row[0]
+
+    def target_state(self, target, state):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO targets VALUES (?, ?)", (target, state))
+            self.db.commit()
+
+    def file_state(self, source, destination, temporary, size, state):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)", (source, destination, temporary, size, state))
+            #'done' needs no commit of its own, it goes with the next one: if
+            #it is lost, recover finds the move 'linked' and has nothing to do
+            if state != 'done':
+                self.db.commit()
+
+    def recover(self):
+        """
+        Finishes or rolls back the file moves that were cut short: partial
+        copies are deleted (the file is moved again from scratch), copies
+        already linked into place have their source removed. A copy still
+        'copying' whose temporary is the destination was linked just before
+        the crash and counts as linked.
+        """
+        with self.lock:
+            rows=self.db.execute("SELECT source, destination, temporary, size, state FROM files WHERE state IN ('copying', 'linked')").fetchall()
+        for source, destination, temporary, size, state in rows:
+            if os.path.lexists(temporary):
+                if os.path.lexists(destination) and os.path.samestat(os.lstat(temporary), os.lstat(destination)):
+                    state='linked'
+                os.remove(temporary)
+            if state == 'linked':
+                if os.path.lexists(source) and os.path.lexists(destination) and os.lstat(destination).st_size == size:
+                    os.remove(source)
+                print('Finished interrupted move '+source+' -> '+destination)
+                self.file_state(source, destination, temporary, size, 'done')
+            else:
+                print('Discarded interrupted copy '+source+' -> '+destination)
+                self.file_state(source, destination, temporary, size, 'discarded')
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
+
+def describe_target(path, mergerfs):
+    """
+    Looks up the branches of a directory on a mergerfs mount and scans them.
+    Returns:
+        dict with the target, its branches (source), its size and collisions,
+        or None if it is not a plain directory on a mergerfs mount
+    """
+    target=os.path.normpath(path)
+    if not os.path.isdir(target) or os.path.islink(target) or os.path.ismount(target):
+        return None
+    absolute=os.path.abspath(target)
+    mountpoint=find_mountpoint(absolute)
+    if str(mountpoint) not in mergerfs.keys():
+        return None
+    relative=os.path.relpath(absolute,start=mountpoint)
     source=[]
-    mergerfs=list_mergerfs()
-    for root, dirs, files in os.walk(path):
-        for name in files:
-            source2=[]
-            target=os.path.normpath(os.path.join(root, name))
-            if os.path.isfile(target) and not os.path.islink(target): 
-                absolute=os.path.abspath(target)
-                mountpoint=find_mountpoint(absolute)
-                if str(mountpoint) in mergerfs.keys():
-                    relative=os.path.relpath(absolute,start=mountpoint)
-                    for branch in mergerfs[mountpoint]:
-                        path=os.path.join(branch,relative)
-                        if os.path.exists(path):
-                            source2.append(path)
-            if len(source2) > 1:
-                source.append(source2)
-    if len(source) > 0 :
-        return(source)
+    for branch in mergerfs[mountpoint]:
+        branchdict={}
+        branchdict['branch']=branch
+        branchdict['relative']=relative
+        branchdict['path']=os.path.join(branch,relative)
+        branchdict['device']=os.stat(branch).st_dev
+        branchdict['freespace']=os.statvfs(branchdict['branch']).f_bavail * os.statvfs(branchdict['branch']).f_frsize
+        branchdict['isbranch']=False
+        branchdict['branchsize']=0
+        branchdict['branchpath']=''
+        if os.path.exists(os.path.join(branch,relative)) and os.path.isdir(os.path.join(branch,relative)) and not (os.path.islink(os.path.join(branch,relative)) or os.path.ismount(os.path.join(branch,relative)) ):
+            branchdict['isbranch']=True
+            branchdict['branchpath']=os.path.join(branch,relative)
+        source.append(branchdict)
+    targetsize, collisions=scan_target(source)
+    return {'target': absolute, 'mountpoint': mountpoint, 'relative': relative, 'size': targetsize, 'collisions': collisions, 'source': source}
+
+def plan_consolidation(targets, minsize_bytes, max_nodes=200000):
+    """
+    Places every target at once, as a bin packing problem: each target goes
+    to one of its branches, the bytes that have to be moved there (what the
+    other branches hold) use up that disk's free space, which must stay above
+    minsize_bytes for every disk after all the moves of the run. Disks shared
+    by several targets (or several pools) are tracked by device.
+    Branch and bound, placing as many targets as possible first and then
+    minimizing the total bytes moved; ties go to the disk with least free
+    space left, like the old greedy rule. The first solution found is the
+    greedy one, so if max_nodes runs out the result is still sensible.
+    Returns:
+        list, in the order of targets, of (branch dict, bytes moved) or None
+        where the target does not fit anywhere
+    """
+    freespace={}
+    for target in targets:
+        for branch in target['source']:
+            freespace[branch['device']]=branch['freespace']
+    #biggest targets first, they are the hardest to fit
+    order=sorted(range(len(targets)), key=lambda t: -targets[t]['size'])
+    minimum=[min([target['size'] - branch['branchsize'] for branch in target['source']] or [0]) for target in targets]
+    remaining=[0]*(len(order)+1)
+    for depth in reversed(range(len(order))):
+        remaining[depth]=remaining[depth+1]+minimum[order[depth]]
+    best={'cost': None, 'assignment': None}
+    assignment=[None]*len(targets)
+    nodes=[0]
+    #explicit stack instead of recursion, there can be thousands of targets:
+    #one frame per target being placed, with the choices still to try
+    stack=[]
+
+    def visit(depth, unplaced, moved):
+        nodes[0]+=1
+        if best['cost'] is not None and ((unplaced, moved+remaining[depth]) >= best['cost'] or nodes[0] > max_nodes):
+            return
+        if depth == len(order):
+            best['cost']=(unplaced, moved)
+            best['assignment']=list(assignment)
+            return
+        t=order[depth]
+        fits=[]
+        for k, branch in enumerate(targets[t]['source']):
+            cost=targets[t]['size'] - branch['branchsize']
+            if freespace[branch['device']] - cost > minsize_bytes:
+                #cheapest first, existing branches first on equal cost, then least free space left
+                fits.append((cost, not branch['isbranch'], freespace[branch['device']] - cost, k))
+        #leaving the target unplaced is tried last
+        choices=[(k, cost) for cost, newbranch, left, k in sorted(fits)]+[(None, 0)]
+        stack.append((depth, unplaced, moved, iter(choices)))
+
+    visit(0, 0, 0)
+    while stack:
+        depth, unplaced, moved, choices=stack[-1]
+        t=order[depth]
+        #undo the choice tried last for this target
+        if assignment[t] is not None:
+            k, cost=assignment[t]
+            freespace[targets[t]['source'][k]['device']]+=cost
+            assignment[t]=None
+        choice=next(choices, None)
+        if choice is None:
+            stack.pop()
+            continue
+        k, cost=choice
+        if k is None:
+            visit(depth+1, unplaced+1, moved)
+        else:
+            freespace[targets[t]['source'][k]['device']]-=cost
+            assignment[t]=(k, cost)
+            visit(depth+1, unplaced, moved+cost)
+    return [None if i is None else (targets[t]['source'][i[0]], i[1]) for t, i in enumerate(best['assignment'])]
+
+def make_plan(targets, minsize_bytes):
+    placements=plan_consolidation(targets, minsize_bytes)
+    plan={'minspace': minsize_bytes, 'bytes_moved': 0, 'targets': [], 'unplaced': []}
+    for target, placement in zip(targets, placements):
+        if placement is None:
+            plan['unplaced'].append(target['target'])
+            continue
+        branch, moved=placement
+        entry=dict(target)
+        entry['destination']=branch['branch']
+        entry['new_branch']=not branch['isbranch']
+        entry['bytes_moved']=moved
+        plan['bytes_moved']+=moved
+        plan['targets'].append(entry)
+    return plan
+
+def print_plan(plan):
+    for entry in plan['targets']:
+        print(entry['target']+' -> '+entry['destination']+(' (new branch)' if entry['new_branch'] else '')+', moving '+str(entry['bytes_moved'])+' of '+str(entry['size'])+' bytes')
+    for target in plan['unplaced']:
+        print(target+': No free space!!!')
+    print('Moving '+str(plan['bytes_moved'])+' bytes in total')
+
+def prepare_target(entry, args, journal=None, scheduler=None):
+    """
+    First stage of a target of the plan: creates the destination branch if
+    needed and handles collisions.
+    Returns:
+        the destination branch dict, or None if the target must not be moved
+    """
+    if scheduler is None:
+        scheduler=DiskScheduler()
+    source=entry['source']
+    collisions=entry['collisions']
+    state=journal.state(entry['target']) if journal is not None else None
+    if state == 'deduped':
+        collisions=None
+    elif collisions is not None:
+        #after a resume some copies may be gone already
+        collisions=[[j for j in i if os.path.lexists(j)] for i in collisions]
+        collisions=[i for i in collisions if len(i) > 1] or None
+    consolidation_branch=[i for i in source if i['branch'] == entry['destination']][0]
+    if entry['new_branch']:
+        consolidation_branch['branchpath']=consolidation_branch['path']
+        if args.dryrun:
+            print('No space in existing branches! (dry run) Creating new one in '+consolidation_branch['branchpath'])
+        else:
+            print('No space in existing branches! Creating new one in '+consolidation_branch['branchpath'])
+            os.makedirs(consolidation_branch['branchpath'], exist_ok=True)
+    if args.collision=="abort":
+        if collisions is not None:
+            print("File collisions found!!!")
+            print(collisions)
+            return None
+    if args.collision=="identical":
+        if collisions is not None:
+            print(collisions)
+            counters=collections.Counter()
+            cache_db=None if args.no_cache else open_cache(args.cache)
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(source))) as executor:
+                for i in collisions:
+                    identical, different, hashes=compare_copies(i, executor, cache_db, counters, scheduler)
+                    print(i[0]+' '+hashes.get(i[0], ''))
+                    for j in identical:
+                        if args.dryrun:
+                            print('Removing (dry run)... ' + j+' '+hashes[j])
+                        else:
+                            print('Removing... ' + j+' '+hashes[j])
+                            if os.path.isfile(j):
+                                os.remove(j)
+                    for j in different:
+                        print(j+' '+hashes.get(j, '(different size)'))
+                    if different:
+                        print("Collision with different files!!!")
+            if cache_db is not None:
+                cache_db.close()
+            print('Hashed '+str(counters['hashed'])+' bytes ('+str(counters['cached'])+' more from cache), skipped '+str(counters['skipped'])+' of '+str(counters['total'])+' bytes in colliding files')
+    if journal is not None:
+        journal.target_state(entry['target'], 'deduped')
+    return consolidation_branch
+
+def move_target(entry, consolidation_branch, args, journal=None, scheduler=None):
+    """
+    Second stage of a target of the plan: moves the other branches into the
+    destination.
+    """
+    if scheduler is None:
+        scheduler=DiskScheduler()
+    source=entry['source']
+    #on a resume, branches already emptied are gone
+    sources=[i for i in source if i['isbranch'] and i['branch']!=consolidation_branch['branch'] and os.path.isdir(i['branchpath'])]
+    if args.mover=="rsync":
+        print("Rsync...")
+        destination=os.path.join(os.path.normpath(os.path.join(consolidation_branch['branchpath'],'..')),'')
+        for i in sources:
+            rsync_branch(i['branchpath'], destination, args.dryrun)
     else:
-        return(None)
-        
+        print("Moving...")
+        progress=Progress()
+        #one worker per source branch, every branch is a different disk
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(sources))) as executor:
+            for future in [executor.submit(move_branch, i['branchpath'], consolidation_branch['branchpath'], args.dryrun, args.verify, progress, journal, scheduler) for i in sources]:
+                future.result()
+        progress.summary()
+    if journal is not None:
+        journal.target_state(entry['target'], 'moved')
+
+def nested_targets(entries):
+    targets=[entry['target'] for entry in entries]
+    return any(k != l and (i == j or j.startswith(i.rstrip('/')+'/')) for k, i in enumerate(targets) for l, j in enumerate(targets))
 
+def run_targets(entries, args, journal=None, scheduler=None):
+    """
+    Executes the targets of the plan as a pipeline: while one is being moved,
+    the collisions of the next args.pipeline ones are handled in the
+    background (their disks are limited by the same scheduler). Only that
+    many are prepared ahead, the rest wait. Targets inside other targets are
+    done one at a time, the move of one would race the dedup of the other.
+    """
+    depth=args.pipeline
+    if depth > 0 and nested_targets(entries):
+        print('Directories inside each other, not pipelining')
+        depth=0
+    if depth == 0:
+        for entry in entries:
+            consolidation_branch=prepare_target(entry, args, journal, scheduler)
+            if consolidation_branch is not None:
+                move_target(entry, consolidation_branch, args, journal, scheduler)
+        return
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        window=collections.deque()
+        for entry in entries:
+            window.append((entry, executor.submit(prepare_target, entry, args, journal, scheduler)))
+            if len(window) > depth:
+                current, future=window.popleft()
+                consolidation_branch=future.result()
+                if consolidation_branch is not None:
+                    move_target(current, consolidation_branch, args, journal, scheduler)
+        while window:
+            current, future=window.popleft()
+            consolidation_branch=future.result()
+            if consolidation_branch is not None:
+                move_target(current, consolidation_branch, args, journal, scheduler)
 
+def refresh_entry(entry, minsize_bytes, committed):
+    """
+    A saved plan may be hours old: rescans the branches of a plan entry and
+    checks the destination still has room for it, on top of what the entries
+    accepted before it in the same run will use up there. committed holds
+    those bytes by device and is updated when the entry is accepted.
+    Returns:
+        True if the entry can still be executed
+    """
+    for branch in entry['source']:
+        branch['device']=os.stat(branch['branch']).st_dev
+        branch['freespace']=os.statvfs(branch['branch']).f_bavail * os.statvfs(branch['branch']).f_frsize
+        branch['isbranch']=os.path.isdir(branch['path']) and not (os.path.islink(branch['path']) or os.path.ismount(branch['path']))
+        branch['branchpath']=branch['path'] if branch['isbranch'] else ''
+        branch['branchsize']=0
+    entry['size'], entry['collisions']=scan_target(entry['source'])
+    destination=[i for i in entry['source'] if i['branch'] == entry['destination']][0]
+    entry['new_branch']=not destination['isbranch']
+    entry['bytes_moved']=entry['size'] - destination['branchsize']
+    if destination['freespace'] - committed[destination['device']] - entry['bytes_moved'] <= minsize_bytes:
+        return False
+    committed[destination['device']]+=entry['bytes_moved']
+    return True
 
 def main():
     parser = argparse.ArgumentParser(description='Consolidate mergerfs files present in multiple branches into one.')
     parser.add_argument('-m','--minspace',help='Minimum space in the filesystem (Accepts suffixes: None, B, KB, MB, GB, TB)', default='400GB')
     parser.add_argument('-c','--collision',help="Action on file collision between branches. abort: abort consolidation; identical: deduplicate identical branches; ignore: ignores existing files", default='identical')
     parser.add_argument('-d','--dryrun',help='Dry run - do not move files', action='store_true', default=False)
-    parser.add_argument('filenames', nargs='+', help='Directory or directories to check')
+    parser.add_argument('--mover',help='How files are moved. native: parallel copy, one worker per source branch; rsync: one rsync per branch, one after the other', default='native', choices=['native', 'rsync'])
+    parser.add_argument('--verify',help='With the native mover, compare the md5 of every copy before removing the source', action='store_true', default=False)
+    parser.add_argument('--cache',help='Hash cache file for identical collisions (default: '+default_cache()+')', default=default_cache())
+    parser.add_argument('--no-cache',help='Do not use the hash cache', action='store_true', default=False)
+    parser.add_argument('--plan',help='Only plan: write the placement of every directory to this JSON file for review, do not move anything', required=False)
+    parser.add_argument('--execute-plan',help='Execute a plan written by --plan instead of planning again (directories are taken from the plan)', required=False)
+    parser.add_argument('--journal',help='Journal of the run, for --resume (default: '+default_journal()+')', default=default_journal())
+    parser.add_argument('--resume',help='Resume the interrupted run recorded in the journal, without planning or scanning again', action='store_true', default=False)
+    parser.add_argument('--disk-jobs',help='Maximum concurrent reads/writes on each disk (branch); the native mover moves that many files at a time per source branch (default: no limit, one file at a time per source branch)', type=int, default=0)
+    parser.add_argument('--disk-rate',help='Maximum throughput on each disk (branch), reads and writes together, per second (Accepts suffixes: None, B, KB, MB, GB, TB; default: no limit)', required=False)
+    parser.add_argument('--ionice',help='Lower the I/O priority of the consolidation (and rsync): idle only uses otherwise idle disks, low is the lowest best-effort priority', choices=['idle', 'low'], required=False)
+    parser.add_argument('--pipeline',help='How many directories ahead get their collisions handled while the current one is moved (default: 1; 0: one directory at a time)', type=int, default=1)
+    parser.add_argument('filenames', nargs='*', help='Directory or directories to check')
     args=parser.parse_args()
     
     minsize_bytes=parse_size(args.minspace)
     
-    mergerfs=list_mergerfs()
-    for i in args.filenames:
-        target=os.path.normpath(i)
-        collisions=find_file_collisions(target)
-        if os.path.isdir(target) and not (os.path.islink(target) or os.path.ismount(target)): 
-            targetsize=dir_size(target)
-            absolute=os.path.abspath(target)
-            mountpoint=find_mountpoint(absolute)
-            source=[]
-            if str(mountpoint) in mergerfs.keys():
-                relative=os.path.relpath(absolute,start=mountpoint)
-                for branch in mergerfs[mountpoint]:
-                    branchdict={}
-                    branchdict['branch']=branch
-                    branchdict['relative']=relative
-                    branchdict['path']=os.path.join(branch,relative)
-                    branchdict['freespace']=os.statvfs(branchdict['branch']).f_bavail * os.statvfs(branchdict['branch']).f_frsize
-                    branchdict['isbranch']=False
-                    branchdict['branchsize']=0
-                    branchdict['branchpath']=''
-                    if os.path.exists(os.path.join(branch,relative)) and os.path.isdir(os.path.join(branch,relative)) and not (os.path.islink(os.path.join(branch,relative)) or os.path.ismount(os.path.join(branch,relative)) ):
-                        branchdict['isbranch']=True
-                        branchdict['branchpath']=os.path.join(branch,relative)
-                        branchdict['branchsize']=dir_size(branchdict['branchpath'])
-                    source.append(branchdict)
-            #find optimal branch for consolidation
-            consolidation_freespace=None
-            consolidation_branch=None
-            consolidation_newbranch=None
-            for i,j in enumerate(source):
-                if j['isbranch']:
-                    free_space_test=j['freespace'] - targetsize + j['branchsize']
-                    if free_space_test > minsize_bytes: 
-                    #move everything to branch with least free space
-                        if (not consolidation_freespace) or free_space_test < consolidation_freespace:
-                            consolidation_branch=source[i]
-                            consolidation_freespace=free_space_test
-            if consolidation_branch is None:
-                for i,j in enumerate(source):
-                    if not j['isbranch']:
-                        free_space_test=j['freespace'] - targetsize + j['branchsize']
-                        if free_space_test > minsize_bytes:
-                        #if a new branch has to be created, use fs with least free space
-                            if (not consolidation_freespace) or free_space_test < consolidation_freespace:
-                                consolidation_branch=source[i]
-                                consolidation_freespace=free_space_test
-                                consolidation_newbranch=True
-            if consolidation_newbranch:
-                if args.dryrun:
-                    print('No space in existing branches! (dry run) Creating new one in '+consolidation_branch['branchpath'])
-                else:
-                    print('No space in existing branches! (dry run) Creating new one in '+consolidation_branch['branchpath'])
-                    os.makedirs(consolidation_branch['branchpath'], exist_ok=True)
-            if consolidation_branch is None:
-                print('No free space!!!')
+    if args.ionice:
+        #inherited by the worker threads and by rsync, so it has to come first
+        ionice_command=['ionice', '-c', '3'] if args.ionice == 'idle' else ['ionice', '-c', '2', '-n', '7']
+        subprocess.run(ionice_command+['-p', str(os.getpid())], check=True)
+    scheduler=DiskScheduler(args.disk_jobs, parse_size(args.disk_rate) if args.disk_rate else 0)
+    if args.resume:
+        if args.dryrun:
+            parser.error('--resume cannot be a dry run')
+        journal=Journal(args.journal)
+        plan=journal.load()
+        if plan is None:
+            parser.error('nothing to resume in '+args.journal)
+        journal.recover()
+        entries=[]
+        for entry in plan['targets']:
+            if journal.state(entry['target']) == 'moved':
+                print(entry['target']+': already consolidated, skipping')
             else:
-                #print(source[consolidation_branch])
-                if args.collision=="abort":
-                    if collisions is not None:
-                        print("File collisions found!!!")
-                        print(collisions)
-                        continue
-                if args.collision=="identical":
-                    if collisions is not None:
-                        print(collisions)
-                        for i in collisions:
-                            hash=None
-                            match=False
-                            for j in i:
-                                if not hash:
-                                    hash=md5sum(j)
-                                    print(j+' '+hash)
-                                else:
-                                    nexthash=md5sum(j)
-                                    if hash==nexthash:
-                                        match=True
-                                        if args.dryrun:
-                                            print('Removing (dry run)... ' + j+' '+nexthash)
-                                        else:
-                                            print('Removing... ' + j+' '+nexthash)
-                                            if os.path.isfile(j):
-                                                os.remove(j)
-                                            
-                                    else:
-                                        match=False
-                                        print(j+' '+nexthash)
-                                        break
-                            if not match:
-                                print("Collision with different files!!!")
-                print("Rsync...")
-                destination=os.path.join(os.path.normpath(os.path.join(consolidation_branch['branchpath'],'..')),'')
-                for i in source:
-                    if i['isbranch']:
-                        if i['branch']!=consolidation_branch['branch']:
-                            #print('rsync -aPx --dry-run --ignore-existing --remove-source-files ' + os.path.join(i['branchpath'])+' '+ destination)
-                            #print('find '+ os.path.join(i['branchpath']) + ' -type d -empty -delete ')
-                            if args.dryrun:
-                                try:
-                                    rsync_command_dryrun=['rsync', '-a', '-P', '-x', '-i', '--ignore-existing', '--remove-source-files', '--dry-run', os.path.join(i['branchpath']), destination]
-                                    find_clean_command_dryrun=['find', os.path.join(i['branchpath']), '-type', 'd', '-empty' ]
-                                    print("Moving (dry run)... "+os.path.join(i['branchpath'])+' -> '+ destination)
-                                    rsync_process=subprocess.run(rsync_command_dryrun, stdin=None, shell=False, check=True)
-                                    print("Deleting empty folders (dry run)... "+os.path.join(i['branchpath']))
-                                    find_clean_process=subprocess.run(find_clean_command_dryrun, stdin=None, shell=False, check=True)
-                                    #print(f)
-                                except subprocess.CalledProcessError as e:
-                                    print(e.output)
-                                    print(e.returncode)
-                                    test_list.remove(i)
-                                    continue
-                            else:
-                                try:
-                                    rsync_command=['rsync', '-a', '-P', '-x', '--ignore-existing', '--remove-source-files', os.path.join(i['branchpath']), destination]
-                                    find_clean_command=['find', os.path.join(i['branchpath']), '-type', 'd', '-empty', '-delete' ]
-                                    print("Moving... "+os.path.join(i['branchpath'])+' -> '+ destination)
-                                    rsync_process=subprocess.run(rsync_command, stdin=None, shell=False, check=True)
-                                    print("Deleting empty folders... "+os.path.join(i['branchpath']))
-                                    find_clean_process=subprocess.run(find_clean_command, stdin=None, shell=False, check=True)
-                                    #print(f)
-                                except subprocess.CalledProcessError as e:
-                                    print(e.output)
-                                    print(e.returncode)
-                                    test_list.remove(i)
-                                    continue
-
-
+                entries.append(entry)
+        run_targets(entries, args, journal, scheduler)
+        journal.close()
+        return
+    if args.execute_plan:
+        with open(args.execute_plan, 'r') as plan_file:
+            plan=json.load(plan_file)
+        entries=[]
+        committed=collections.Counter()
+        for entry in plan['targets']:
+            if refresh_entry(entry, plan['minspace'], committed):
+                entries.append(entry)
+            else:
+                print(entry['target']+': not enough free space left in '+entry['destination']+' since the plan was made, skipping')
+        plan['targets']=entries
+    else:
+        if not args.filenames:
+            parser.error('directories are required unless --execute-plan or --resume is given')
+        mergerfs=list_mergerfs()
+        targets=[]
+        for i in args.filenames:
+            target=describe_target(i, mergerfs)
+            if target is not None:
+                targets.append(target)
+        plan=make_plan(targets, minsize_bytes)
+        print_plan(plan)
+        if args.plan:
+            with open(args.plan, 'w') as plan_file:
+                json.dump(plan, plan_file, indent=2)
+            print('Plan written to '+args.plan)
+            return
+    journal=None
+    if not args.dryrun:
+        journal=Journal(args.journal)
+        #a previous run may have been cut short in the middle of a file
+        journal.recover()
+        journal.start(plan)
+    run_targets(plan['targets'], args, journal, scheduler)
+    if journal is not None:
+        journal.close()
 
 main()
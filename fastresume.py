@@ -1,6 +1,8 @@
 #!/usr/bin/python3
 #requires: py3-bencode >= 0.0.3
-import os, sys, hashlib, math, time, argparse, itertools
+import os, sys, hashlib, math, time, argparse, itertools, collections, bisect, random
+import concurrent.futures
+import sqlite3, json, threading
 from bencode import bencode, bdecode
 
 
@@ -19,15 +21,108 @@ def sanitize_bytes(value):
 
 def custom_decoder(field_type, value):
     if field_type == "key":
-        return str(value, "ascii")
+        return str(value, "utf-8", "surrogateescape")
     elif field_type == "value":
         return value
     else:
         raise Exception("'field_type' can pass only 'key' and 'value' values")
         
-def pieces_generator(files, piece_length):
+class Stats:
     """
-    shamelessly copy-pasted from 
+    Thread-safe counters for --stats: bytes read and time spent reading every
+    file, bytes hashed and time spent hashing (summed over all the workers), and
+    any other named timings (bencode decoding and encoding).
+    """
+    def __init__(self):
+        self.lock=threading.Lock()
+        self.start=time.perf_counter()
+        self.files={}
+        self.hashed_bytes=0
+        self.hash_time=0.0
+        self.times=collections.Counter()
+
+    def read(self, file, size, seconds):
+        with self.lock:
+            entry=self.files.setdefault(file, {'bytes':0, 'time':0.0})
+            entry['bytes']+=size
+            entry['time']+=seconds
+
+    def hashed(self, size, seconds):
+        with self.lock:
+            self.hashed_bytes+=size
+            self.hash_time+=seconds
+
+    def timed(self, name, seconds):
+        with self.lock:
+            self.times[name]+=seconds
+
+    def summary(self):
+        with self.lock:
+            read_bytes=sum(entry['bytes'] for entry in self.files.values())
+            read_time=sum(entry['time'] for entry in self.files.values())
+            return {
+                'wall_time':time.perf_counter()-self.start,
+                'read_bytes':read_bytes,
+                'read_time':read_time,
+                'read_mb_s':read_bytes/2**20/read_time if read_time else 0,
+                'hash_bytes':self.hashed_bytes,
+                'hash_time':self.hash_time,
+                'hash_mb_s':self.hashed_bytes/2**20/self.hash_time if self.hash_time else 0,
+                'times':dict(self.times),
+                'files':{file: dict(entry, mb_s=entry['bytes']/2**20/entry['time'] if entry['time'] else 0) for file, entry in self.files.items()},
+            }
+
+def print_stats(summary):
+    print('Statistics:')
+    for file, entry in summary['files'].items():
+        print('  '+file+': '+str(entry['bytes'])+' bytes in '+format(entry['time'], '.3f')+'s ('+format(entry['mb_s'], '.1f')+' MB/s)')
+    print('read: '+str(summary['read_bytes'])+' bytes, '+format(summary['read_time'], '.3f')+'s blocked on I/O ('+format(summary['read_mb_s'], '.1f')+' MB/s)')
+    print('hash: '+str(summary['hash_bytes'])+' bytes, '+format(summary['hash_time'], '.3f')+'s hashing over all threads ('+format(summary['hash_mb_s'], '.1f')+' MB/s per thread)')
+    for name, seconds in sorted(summary['times'].items()):
+        print(name+': '+format(seconds, '.3f')+'s')
+    print('wall time: '+format(summary['wall_time'], '.3f')+'s')
+
+def timed_readinto(f, view, stats=None):
+    """
+    f.readinto(view), recording how long it was blocked in stats if given.
+    """
+    start=time.perf_counter()
+    read=f.readinto(view)
+    if stats is not None:
+        stats.read(f.name, read or 0, time.perf_counter()-start)
+    return read
+
+def open_piece_file(file, sequential=True):
+    """
+    Opens a file to read pieces from, unbuffered since pieces are read straight
+    into their own buffers, and tells the kernel how it is going to be read:
+    front to back, so it can read ahead aggressively, or jumping around, where
+    readahead would just be wasted.
+    """
+    print('  ' + file)
+    f=open(file, 'rb', buffering=0)
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL if sequential else os.POSIX_FADV_RANDOM)
+    return f
+
+def read_range(f, view, stats=None):
+    """
+    Fills view from the current position of f, recording the reads in stats if
+    given.
+    Returns:
+        number of bytes read, less than len(view) only at the end of the file
+    """
+    filled=0
+    while filled < len(view):
+        read=timed_readinto(f, view[filled:], stats)
+        if not read:
+            break
+        filled+=read
+    return filled
+
+def pieces_generator(files, piece_length, buffers=1, lengths=None, indexes=None, pads=(), stats=None, sequential=True):
+    """
+    Originally copy-pasted from
     https://github.com/jbernhard/scripts/blob/master/verify-torrent
     """
     """
@@ -36,199 +131,913 @@ def pieces_generator(files, piece_length):
     file boundaries.  The first piece of a file may complete the final partial
     piece from the previous file, and some small files (e.g. nfo) use less than
     one piece.
+    Pieces are read straight into a small ring of preallocated buffers instead
+    of building a new bytes object for every piece, so a piece spanning several
+    files is just filled up in place.  The yielded memoryview is only valid until
+    the ring wraps around, i.e. for the next buffers-1 pieces; whoever consumes
+    them (see hash_pieces) must be done with a piece before then.
+    If indexes is given only those pieces are read, seeking to each of them
+    instead of reading the files front to back. Unless sequential is False
+    (a sample jumping around), the files are still read mostly front to back,
+    only skipping the parts already verified, so readahead is kept on.
+    Padding files (BEP 47, used by hybrid v1/v2 torrents) are never read, they
+    are just zeros.
     Arguments:
         files -- list of files to break into pieces
         piece_length -- size of pieces in bytes
+        buffers -- number of piece buffers in the ring
+        lengths -- list of file lengths, only needed with indexes or pads
+        indexes -- sorted list of the pieces to read (default: all of them)
+        pads -- set of the files that are padding
+        stats -- Stats to record the reads in, if any
+        sequential -- whether to ask for readahead on the files read with indexes
     Yields:
-        bytes objects with specified size
+        memoryviews of the pieces with specified size
     """
 
-    piece = None
+    ring=[bytearray(piece_length) for i in range(max(1, buffers))]
+    current=0
+    view=memoryview(ring[current])
+    filled=0
 
-    for file in files:
-        print('  ' + file)
+    if indexes is not None:
+        offsets=file_offsets(lengths)
+        f=None
+        try:
+            for index in indexes:
+                for file, start, end in piece_files(files, lengths, piece_length, index, offsets):
+                    if file in pads:
+                        view[filled:filled+end-start]=bytes(end-start)
+                        filled+=end-start
+                        continue
+                    if f is None or f.name != file:
+                        if f is not None:
+                            f.close()
+                        f=open_piece_file(file, sequential)
+                    f.seek(start)
+                    # a short read means the file is truncated, the piece is
+                    # yielded anyway and will fail
+                    filled+=read_range(f, view[filled:filled+end-start], stats)
+                yield view[:filled]
+                current=(current+1)%len(ring)
+                view=memoryview(ring[current])
+                filled=0
+        finally:
+            if f is not None:
+                f.close()
+        return
 
-        with open(file, 'rb') as f:
-            # if there is an existing piece [from a previous file]
-            # read only enough to complete the piece
-            if piece:
-                piece += f.read(piece_length - len(piece))
+    for i, file in enumerate(files):
+        if file in pads:
+            remaining=lengths[i]
+            while remaining:
+                size=min(remaining, piece_length-filled)
+                view[filled:filled+size]=bytes(size)
+                filled+=size
+                remaining-=size
+                if filled == piece_length:
+                    yield view
+                    current=(current+1)%len(ring)
+                    view=memoryview(ring[current])
+                    filled=0
+            continue
 
-                # only yield if the piece is complete
-                if len(piece) == piece_length:
-                    yield piece
-                else:
-                    continue
-
-            # now read full pieces normally
+        with open_piece_file(file) as f:
+            # keep filling the current piece [which might have been started by
+            # a previous file] and yield it whenever it is complete
             while True:
-                piece = f.read(piece_length)
-
-                # only yield if the piece is complete
-                if len(piece) == piece_length:
-                    yield piece
-                else:
+                filled+=read_range(f, view[filled:], stats)
+                if filled < piece_length:
                     break
+                yield view
+                current=(current+1)%len(ring)
+                view=memoryview(ring[current])
+                filled=0
 
     # yield the final piece
-    if piece:
-        yield piece
-
-
-parser = argparse.ArgumentParser(description='Append fastresume information to torrent.')
-parser.add_argument('-i', '--infile', help='Original torrent file.', nargs=1, required=True)
-parser.add_argument('-p', '--path', help='Path to the files contained in the torrent.', nargs=1, required=True)
-parser.add_argument('-o', '--outfile', help='Output torrent file with fastresume data.', nargs=1, required=True)
-parser.add_argument('-v', '--verify', help='Verify all hashes.', action="store_true", default=False, required=False)
-parser.add_argument('-c', '--clobber', help='Overwrite target file if it already exists.', action="store_true", default=False, required=False)
-parser.add_argument('-r', '--remove', help='Remove fastresume data.', action="store_true", default=False, required=False)
-parser.add_argument('--verbose', help='Decodes and dumps the torrent information on screen.', action="store_true", default=False, required=False)
-args=parser.parse_args()
-torrent_filename=args.infile[0]
-content_path=args.path[0]
-outfile=args.outfile[0]
-verify_hashes=args.verify
-remove=args.remove
-clobber=args.clobber
-
-if not os.path.isfile(torrent_filename):
-    print('Source file does not exist!')
-    exit(1)
-if os.path.isfile(outfile) and not clobber:
-    print('Output file already exists. Use argument --clobber (-c) to overwrite.')
-    exit(1)
-
-with open(torrent_filename, 'rb') as torrentfile:
-    metadata=bdecode(torrentfile.read(), decoder=custom_decoder)
-
-if remove:
-    print('Removing fastresume metadata from torrent...')
-    if 'rtorrent' in metadata:
-        print('Previous rtorrent configuration found. Deleting...')
-        del metadata['rtorrent']
-    if 'libtorrent_resume' in metadata:
-        print('Previous fastresume data found. Deleting...')
-        del metadata['libtorrent_resume']
-    if args.verbose:
-        print('Dumping torrent metadata...')
-        print(metadata)
-    with open(outfile,'wb') as output:
-        output.write(bencode(metadata))
-    exit(0)
-
-if args.verbose:
-    print('Dumping torrent metadata...')
-    print(metadata)
-
-if 'rtorrent' in metadata:
-    print('Previous rtorrent configuration found. Deleting...')
-    del metadata['rtorrent']
-if 'libtorrent_resume' in metadata:
-    print('Previous fastresume data found. Deleting...')
-    del metadata['libtorrent_resume']
-
-metadata_fastresume=metadata
-
-files=[]
-tsize=0
-sanitized_files=[]
-if 'info' in metadata:
-    if 'piece length' in metadata['info']:
-        psize=metadata['info']['piece length']
-    if 'files' in metadata['info']:
-        print('multi-file torrent')
-        for file in metadata['info']['files']:
-            file_info={}
-            file_info.clear()     
-            sanitized_path=[]
-            filepath=os.path.join(content_path.encode("utf-8"), sanitize_bytes(metadata['info']['name']))
-            for i in file['path']:
-                sanitized_path.append(sanitize_bytes(i))
-                filepath=os.path.join(filepath,sanitize_bytes(i))
-            print(filepath)
-            files.append(str(filepath,"utf-8"))
-            tsize += file['length']
-            #Some torrent files store file attributes here, which is not 100% standard.
-            #I would love to clean that extra info if present,
-            #but that would change the torrentid and might give tracker problems.
-            if 'attr' in file: file_info['attr']=file['attr']
-            if 'md5sum' in file: file_info['md5sum']=file['md5sum']
-            file_info['length']=file['length']
-            file_info['path']=sanitized_path
-            sanitized_files.append(file_info)
-        metadata_fastresume['info']['files']=sanitized_files
+    if filled:
+        yield view[:filled]
+
+def sha1_piece(piece, stats=None):
+    start=time.perf_counter()
+    digest=hashlib.sha1(piece).digest()
+    if stats is not None:
+        stats.hashed(len(piece), time.perf_counter()-start)
+    return digest
+
+def hash_pieces(pieces, jobs=1, window=None, stats=None):
+    """
+    Hashes pieces in a pool of worker threads (hashlib releases the GIL while
+    hashing, so threads are enough to use several cores).
+    Only a small window of pieces is kept in flight so memory stays bounded,
+    and the digests are yielded back in the same order as the pieces.
+    Arguments:
+        pieces -- iterable of pieces, usually from pieces_generator
+        jobs -- number of worker threads
+        window -- maximum number of pieces in flight (default: jobs*2); when
+                  reading with pieces_generator it needs at least this many buffers
+        stats -- Stats to record the hashing in, if any
+    Yields:
+        sha1 digests of every piece, in order
+    """
+    if window is None:
+        window=jobs*2
+    pending=collections.deque()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        for piece in pieces:
+            pending.append(executor.submit(sha1_piece, piece, stats))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def verify_pieces(hashed_pieces, allhashes, report=False, indexes=None):
+    """
+    Compares the hashed pieces against the 'pieces' table as they come, without
+    keeping any of them around.
+    Stops at the first mismatch unless report is set, in which case it keeps
+    going and returns every bad piece.
+    If only some pieces were hashed, indexes is the list of which ones.
+    Returns:
+        list of the indexes of the pieces that failed (empty if all passed),
+        and how many pieces were compared
+    """
+    if indexes is None:
+        indexes=itertools.count()
+        hashes=(allhashes[i:i+20] for i in range(0, len(allhashes), 20))
     else:
-        print('single-file torrent')
-        files.append(os.path.join(content_path,str(metadata['info']['name'], "utf-8")))
-        tsize=int(str(metadata['info']['length']))
-chunks=int((tsize + psize - 1)/ psize)
-if chunks*20 != len(metadata['info']['pieces']):
-    print("Inconsistent piece information")
-
-
-pmod=0
-metadata_fastresume['libtorrent_resume']={}
-metadata_fastresume['libtorrent_resume']['bitfield']=chunks
-metadata_fastresume['libtorrent_resume']['files']=[]
-for i, file in enumerate(files):
-    if os.path.isfile(file):
-        mtime=int(os.stat(file).st_mtime)
-
-        if 'files' in metadata['info']:
-            fsize=metadata['info']['files'][i]['length']
+        hashes=(allhashes[i*20:i*20+20] for i in indexes)
+    failed=[]
+    checked=0
+    for index, (h1, h2) in zip(indexes, itertools.zip_longest(hashed_pieces, hashes)):
+        checked+=1
+        if h1 != h2:
+            failed.append(index)
+            if not report:
+                break
+    return failed, checked
+
+def file_offsets(lengths):
+    """
+    Returns the byte offset of every file inside the torrent, plus the total size
+    at the end.
+    """
+    return list(itertools.accumulate(lengths, initial=0))
+
+def file_pieces(offsets, lengths, piece_length, i):
+    """
+    Returns the range of pieces covering file i (empty for empty files).
+    """
+    if lengths[i] == 0:
+        return range(0)
+    return range(offsets[i]//piece_length, (offsets[i]+lengths[i]-1)//piece_length+1)
+
+def piece_files(files, lengths, piece_length, index, offsets=None):
+    """
+    Maps a piece back to the file or files it covers.
+    Returns:
+        list of (file, start, end) tuples, with start and end being byte offsets
+        inside each file (end is exclusive)
+    """
+    if offsets is None:
+        offsets=file_offsets(lengths)
+    piece_start=index*piece_length
+    piece_end=piece_start+piece_length
+    ranges=[]
+    i=bisect.bisect_right(offsets, piece_start)-1
+    while 0 <= i < len(files) and offsets[i] < piece_end:
+        if lengths[i] > 0:
+            ranges.append((files[i], max(piece_start-offsets[i], 0), min(piece_end-offsets[i], lengths[i])))
+        i+=1
+    return ranges
+
+def sample_pieces(offsets, lengths, piece_length, chunks, fraction, seed):
+    """
+    Picks the pieces checked by a sampled verification: the first and last piece
+    of every file (which includes every piece spanning a file boundary, so
+    truncated or misplaced files show up), plus a random fraction of the rest.
+    The random part depends only on seed, so the same torrent always gets the
+    same sample.
+    Returns:
+        sorted list of piece indexes
+    """
+    sample=set()
+    for i in range(len(lengths)):
+        pieces=file_pieces(offsets, lengths, piece_length, i)
+        if pieces:
+            sample.add(pieces[0])
+            sample.add(pieces[-1])
+    rest=[index for index in range(chunks) if index not in sample]
+    sample.update(random.Random(seed).sample(rest, min(len(rest), int(len(rest)*fraction))))
+    return sorted(sample)
+
+BLOCK_SIZE=16384
+
+def merkle_root(hashes, width, pad=bytes(32)):
+    """
+    Root of a BitTorrent v2 merkle tree (BEP 52) over hashes, padded up to width
+    leaves (a power of two) with pad, whose parents are used to pad the
+    upper layers.
+    """
+    layer=list(hashes)
+    while width > 1:
+        if len(layer)%2:
+            layer.append(pad)
+        layer=[hashlib.sha256(layer[i]+layer[i+1]).digest() for i in range(0, len(layer), 2)]
+        pad=hashlib.sha256(pad+pad).digest()
+        width//=2
+    return layer[0] if layer else pad
+
+def v2_files(file_tree, path=[]):
+    """
+    Flattens a v2 'file tree' into a list of (path, length, pieces root) tuples,
+    in torrent order. path is a list of the path components as bytes, and the
+    pieces root is None for empty files.
+    """
+    result=[]
+    for name, node in file_tree.items():
+        name=name.encode("utf-8", "surrogateescape")
+        if '' in node:
+            result.append((path+[name], node['']['length'], node[''].get('pieces root')))
+        else:
+            result+=v2_files(node, path+[name])
+    return result
+
+def verify_v2_file(file, length, piece_length, pieces_root, piece_layer, stats=None):
+    """
+    Checks a single file against its v2 merkle tree. v2 pieces never cross
+    file boundaries, so every file can be checked on its own.
+    Files bigger than one piece are checked piece by piece against their
+    'piece layers' entry (which has to hash up to the pieces root), smaller
+    ones directly against the pieces root.
+    Returns:
+        list of the pieces that failed, counted from the start of the file
+    """
+    pieces=(length+piece_length-1)//piece_length
+    if length > piece_length:
+        expected=[piece_layer[i:i+32] for i in range(0, len(piece_layer or b''), 32)]
+        zero_piece=merkle_root([], piece_length//BLOCK_SIZE)
+        if len(expected) != pieces or merkle_root(expected, 1 << (pieces-1).bit_length(), zero_piece) != pieces_root:
+            print('Inconsistent piece layer for '+file)
+            return list(range(pieces))
+    buffer=bytearray(piece_length)
+    view=memoryview(buffer)
+    failed=[]
+    try:
+        f=open_piece_file(file)
+    except OSError:
+        return list(range(pieces))
+    with f:
+        for index in range(pieces):
+            size=min(piece_length, length-index*piece_length)
+            filled=read_range(f, view[:size], stats)
+            start=time.perf_counter()
+            blocks=[hashlib.sha256(view[i:min(i+BLOCK_SIZE, filled)]).digest() for i in range(0, filled, BLOCK_SIZE)]
+            if length > piece_length:
+                good=filled == size and merkle_root(blocks, piece_length//BLOCK_SIZE) == expected[index]
+            else:
+                good=filled == size and merkle_root(blocks, 1 << (len(blocks)-1).bit_length()) == pieces_root
+            if stats is not None:
+                stats.hashed(filled, time.perf_counter()-start)
+            if not good:
+                failed.append(index)
+    return failed
+
+def verify_v2(files, lengths, roots, layers, piece_length, jobs=1, report=False, indexes=None, stats=None):
+    """
+    Verifies files against their v2 merkle trees, one file per worker thread.
+    Stops handing out new files after the first failure unless report is set.
+    Arguments:
+        roots -- pieces root of every file, None for files with nothing to check
+                 (empty or padding)
+        layers -- the 'piece layers' dictionary
+        indexes -- files to check (default: every file with a pieces root)
+        stats -- Stats to record the reads and hashing in, if any
+    Returns:
+        dict of file index: list of the pieces that failed, for the files that
+        failed, and the list of files that were actually checked
+    """
+    if indexes is None:
+        indexes=[i for i in range(len(files)) if roots[i] is not None]
+    failed={}
+    checked=[]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        futures={executor.submit(verify_v2_file, files[i], lengths[i], piece_length, roots[i], layers.get(roots[i]), stats): i for i in indexes}
+        for future in concurrent.futures.as_completed(futures):
+            i=futures[future]
+            if future.cancelled():
+                continue
+            checked.append(i)
+            if future.result():
+                failed[i]=future.result()
+                if not report:
+                    for pending in futures:
+                        pending.cancel()
+    return failed, checked
+
+def default_cache():
+    return os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'fastresume', 'verify.sqlite')
+
+def open_cache(cache_file):
+    """
+    Opens (creating it if needed) the verification cache.
+    Every row is a file that passed verification, keyed by its identity on disk
+    (device, inode, size, mtime) and by what it was verified against (piece
+    length, infohash and the offset of the file inside the torrent, since the
+    same file can be linked more than once). Any change in those fields just
+    misses the cache.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(cache_file)), exist_ok=True)
+    cache_db=sqlite3.connect(cache_file, timeout=60)
+    cache_db.execute("""
+    CREATE TABLE IF NOT EXISTS verified (
+        device INTEGER, inode INTEGER, size INTEGER, mtime INTEGER,
+        piece_length INTEGER, infohash TEXT, offset INTEGER,
+        path TEXT, verified_date INTEGER,
+        PRIMARY KEY (device, inode, size, mtime, piece_length, infohash, offset)
+    );
+    """)
+    return cache_db
+
+def file_identity(file):
+    file_stat=os.stat(file)
+    return (file_stat.st_dev, file_stat.st_ino, file_stat.st_size, file_stat.st_mtime_ns)
+
+def cached_files(cache_db, identities, piece_length, infohash, offsets):
+    """
+    Returns the set of file indexes that are already verified in the cache.
+    Files without an identity (None, e.g. missing files) are never verified.
+    """
+    verified=set()
+    for i, identity in enumerate(identities):
+        if identity is None:
+            continue
+        row=cache_db.execute("SELECT 1 FROM verified WHERE device=? AND inode=? AND size=? AND mtime=? AND piece_length=? AND infohash=? AND offset=?;", identity+(piece_length, infohash, offsets[i])).fetchone()
+        if row:
+            verified.add(i)
+    return verified
+
+def cache_files(cache_db, files, identities, piece_length, infohash, offsets, verified):
+    with cache_db:
+        cache_db.executemany("INSERT OR REPLACE INTO verified VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);", [identities[i]+(piece_length, infohash, offsets[i], files[i], int(time.time())) for i in verified])
+
+def prune_cache(cache_db):
+    """
+    Deletes the cache entries of files that no longer exist or have changed.
+    Returns:
+        number of entries deleted
+    """
+    stale=[]
+    for row in cache_db.execute("SELECT device, inode, size, mtime, path FROM verified;").fetchall():
+        try:
+            if file_identity(row[4]) != tuple(row[:4]):
+                stale.append(row[:4])
+        except OSError:
+            stale.append(row[:4])
+    with cache_db:
+        cache_db.executemany("DELETE FROM verified WHERE device=? AND inode=? AND size=? AND mtime=?;", stale)
+    cache_db.execute("VACUUM;")
+    return len(stale)
+
+def bencode_end(data, start):
+    """
+    Returns the position right after the bencoded value starting at start,
+    skipping over it without decoding anything (so a multi-MB 'pieces' string
+    costs nothing).
+    """
+    i=start
+    depth=0
+    while True:
+        if data[i] in b'dl':
+            depth+=1
+            i+=1
+        elif data[i] == ord('e'):
+            depth-=1
+            i+=1
+        elif data[i] == ord('i'):
+            i=data.index(b'e', i)+1
         else:
-            fsize=1
-        if not not pmod :
-            fchunks=1
+            colon=data.index(b':', i)
+            i=colon+1+int(data[i:colon])
+        if depth <= 0:
+            return i
+
+def bencode_entries(data):
+    """
+    Splits the top level dictionary of a torrent into its raw entries.
+    Returns:
+        dict of key: (start, value_start, end) tuples, where start is where the
+        key begins, value_start where the value begins and end where it ends, in
+        the original order
+    """
+    if data[:1] != b'd':
+        raise Exception('not a valid torrent file')
+    entries={}
+    i=1
+    try:
+        while data[i] != ord('e'):
+            colon=data.index(b':', i)
+            value_start=colon+1+int(data[i:colon])
+            key=str(data[colon+1:value_start], "ascii")
+            end=bencode_end(data, value_start)
+            entries[key]=(i, value_start, end)
+            i=end
+    except (IndexError, ValueError):
+        raise Exception('not a valid torrent file')
+    return entries
+
+def splice_torrent(data, entries, replace):
+    """
+    Rebuilds the torrent copying the original entries byte for byte, so the
+    info dictionary (and the infohash) is never touched.
+    Arguments:
+        data -- the original torrent
+        entries -- its raw entries, from bencode_entries
+        replace -- dict of top level keys to add or replace, a value of None
+                   deletes the key
+    """
+    new_entries=sorted((key, value) for key, value in replace.items() if value is not None)
+    output=bytearray(b'd')
+    for key, (start, value_start, end) in entries.items():
+        if key in replace:
+            continue
+        while new_entries and new_entries[0][0] < key:
+            output+=bencode(new_entries[0][0])+bencode(new_entries.pop(0)[1])
+        output+=data[start:end]
+    for key, value in new_entries:
+        output+=bencode(key)+bencode(value)
+    output+=b'e'
+    return bytes(output)
+
+def write_torrent(outfile, data):
+    """
+    Writes to a temporary file next to the output and renames it into place, so
+    an interrupted run never leaves a truncated torrent behind.
+    """
+    tmpfile=outfile+'.tmp'
+    with open(tmpfile,'wb') as output:
+        output.write(data)
+    os.replace(tmpfile, outfile)
+
+def fastresume(torrent_filename, content_path, outfile, verify_hashes=False, report=False, jobs=1, clobber=False, remove=False, verbose=False, cache=None, partial=False, sample_fraction=0.01, stats=None):
+    """
+    Appends (or removes, with remove) the fastresume data to a single torrent.
+    verify_hashes is False, 'full' or 'sample' (see sample_pieces, with
+    sample_fraction of the remaining pieces picked at random).
+    cache is the path to the verification cache, or None to always verify
+    everything.
+    With partial, missing files and bad pieces do not stop the resume data from
+    being written: everything is hashed and only the good pieces are marked as
+    done, so the client just downloads the rest.
+    stats is a Stats to record the timings in, if any.
+    v2 and hybrid torrents are verified against their v2 merkle trees, in
+    parallel one file per worker (except for sampled or partial verification of
+    hybrid torrents, which use the v1 pieces). v2-only torrents cannot be loaded
+    by rtorrent, so they are only verified.
+    Returns:
+        'ok', 'inconsistent pieces' (the output is still written, as always),
+        'partial' (with partial, when some pieces are missing or bad), or the
+        reason no output was written: 'source missing', 'output exists',
+        'missing files', 'hash failure' or 'v2 only'
+    """
+    if not os.path.isfile(torrent_filename):
+        print('Source file does not exist!')
+        return 'source missing'
+    if os.path.isfile(outfile) and not clobber:
+        print('Output file already exists. Use argument --clobber (-c) to overwrite.')
+        return 'output exists'
+
+    with open(torrent_filename, 'rb') as torrentfile:
+        data=torrentfile.read()
+    # only the info dictionary gets decoded, everything else is copied as is
+    start=time.perf_counter()
+    entries=bencode_entries(data)
+    metadata={}
+    if 'info' in entries:
+        metadata['info']=bdecode(data[entries['info'][1]:entries['info'][2]], decoder=custom_decoder)
+    # v2 piece layers are keyed by the binary pieces root, so no custom_decoder
+    layers={}
+    if 'piece layers' in entries:
+        layers=bdecode(data[entries['piece layers'][1]:entries['piece layers'][2]])
+    if stats is not None:
+        stats.timed('bencode decode', time.perf_counter()-start)
+
+    if verbose:
+        print('Dumping torrent metadata...')
+        print(bdecode(data, decoder=custom_decoder))
+
+    if 'rtorrent' in entries:
+        print('Previous rtorrent configuration found. Deleting...')
+    if 'libtorrent_resume' in entries:
+        print('Previous fastresume data found. Deleting...')
+
+    if remove:
+        print('Removing fastresume metadata from torrent...')
+        start=time.perf_counter()
+        output=splice_torrent(data, entries, {'rtorrent':None, 'libtorrent_resume':None})
+        if stats is not None:
+            stats.timed('bencode encode', time.perf_counter()-start)
+        write_torrent(outfile, output)
+        return 'ok'
+
+    metadata_fastresume={}
+    status='ok'
+
+    files=[]
+    lengths=[]
+    pads=set()
+    roots=[]
+    tsize=0
+    v2_only=False
+    if 'info' in metadata:
+        if 'piece length' in metadata['info']:
+            psize=metadata['info']['piece length']
+        tree=v2_files(metadata['info']['file tree']) if 'file tree' in metadata['info'] else []
+        v2_only='file tree' in metadata['info'] and 'pieces' not in metadata['info']
+        if v2_only:
+            print('v2-only torrent')
+            #single-file v2 torrents have just the file at the top of the tree
+            if len(tree) == 1 and len(tree[0][0]) == 1:
+                base=content_path.encode("utf-8")
+            else:
+                base=os.path.join(content_path.encode("utf-8"), sanitize_bytes(metadata['info']['name']))
+            for path, length, root in tree:
+                filepath=os.path.join(base, *path)
+                print(filepath)
+                files.append(str(filepath,"utf-8"))
+                lengths.append(length)
+                roots.append(root)
+                tsize += length
+        elif 'files' in metadata['info']:
+            print('multi-file torrent')
+            v2_roots=iter(root for path, length, root in tree)
+            for file in metadata['info']['files']:
+                #The info dictionary is copied untouched to the output, so
+                #non-standard extras in here (attr, md5sum...) are kept as they are.
+                filepath=os.path.join(content_path.encode("utf-8"), sanitize_bytes(metadata['info']['name']))
+                for i in file['path']:
+                    filepath=os.path.join(filepath,sanitize_bytes(i))
+                print(filepath)
+                files.append(str(filepath,"utf-8"))
+                lengths.append(file['length'])
+                tsize += file['length']
+                #hybrid torrents pad every file to a piece boundary with padding
+                #files, which are not in the v2 file tree
+                if b'p' in file.get('attr', b''):
+                    pads.add(files[-1])
+                    roots.append(None)
+                else:
+                    roots.append(next(v2_roots, None))
         else:
+            print('single-file torrent')
+            files.append(os.path.join(content_path,str(metadata['info']['name'], "utf-8")))
+            tsize=int(str(metadata['info']['length']))
+            lengths.append(tsize)
+            roots.append(tree[0][2] if tree else None)
+    chunks=int((tsize + psize - 1)/ psize)
+    if not v2_only and chunks*20 != len(metadata['info']['pieces']):
+        print("Inconsistent piece information")
+        status='inconsistent pieces'
+
+
+    missing=set()
+    pmod=0
+    metadata_fastresume['libtorrent_resume']={}
+    metadata_fastresume['libtorrent_resume']['bitfield']=chunks
+    metadata_fastresume['libtorrent_resume']['files']=[]
+    for i, file in enumerate(files):
+        if os.path.isfile(file) or file in pads:
+            mtime=int(os.stat(file).st_mtime) if os.path.isfile(file) else 0
+
+            if 'files' in metadata['info']:
+                fsize=metadata['info']['files'][i]['length']
+            else:
+                fsize=1
+            if not not pmod :
+                fchunks=1
+            else:
+                fchunks=0
+            if pmod >= fsize :
+                pmod=pmod - fsize
+                fsize=0
+            else:
+                fsize=fsize - pmod
+                pmod=0
+            fchunks+= math.ceil(fsize/psize)
+            if pmod==0:
+                pmod=psize-(fsize%psize)
+        elif partial:
+            print('Missing file: '+file)
+            missing.add(i)
+            mtime=0
             fchunks=0
-        if pmod >= fsize :
-            pmod=pmod - fsize
-            fsize=0
         else:
-            fsize=fsize - pmod
-            pmod=0
-        fchunks+= math.ceil(fsize/psize)
-        if pmod==0:
-            pmod=psize-(fsize%psize)
-    else:
-        print('Missing files or incorrect download path. Exiting...')
-        exit()
-
-    metadata_fastresume['libtorrent_resume']['files'].append({'priority':0 , 'mtime': mtime, 'completed':fchunks})
-metadata_fastresume['libtorrent_resume']['uncertain_pieces.timestamp']=int(time.time())
-
-if 'files' in metadata['info']:
-    content_path=os.path.join(content_path,str(metadata['info']['name'], "utf-8"))
-
-metadata_fastresume['rtorrent']={
-"state": 1,
-"state_changed":int(time.time()),
-"state_counter":1,
-"chunks_wanted":0,
-"chunks_done":chunks,
-"complete":1,
-"hashing":0,
-"directory": content_path if os.path.isabs(content_path) else os.path.abspath(content_path),
-"tied_to_file":outfile if os.path.isabs(outfile) else os.path.abspath(outfile),
-"timestamp_finished":0,
-"timestamp_started":int(time.time())
-}
-
-print('infohash='+hashlib.sha1(bencode(metadata['info'])).hexdigest())
-
-if verify_hashes:
-    print('Verifying hashes...')
-    pieces_to_hash=pieces_generator(files, metadata['info']['piece length'])
-    hashed_pieces = (hashlib.sha1(piece).digest() for piece in pieces_to_hash)
-    allhashes=metadata['info']['pieces']
-    hashes=(allhashes[i:i+20] for i in range(0, len(allhashes), 20))
-    pairs = itertools.zip_longest(list(hashed_pieces), list(hashes))
-    success = all(h1 == h2 for h1, h2 in pairs)
-    print('Passed!' if success else 'FAILED', end='\n\n')
-    if not success:
-        print('Exiting without generating fastresume file...')
-        exit(1)
-
-with open(outfile,'wb') as output:
-    output.write(bencode(metadata_fastresume))
+            print('Missing files or incorrect download path. Exiting...')
+            return 'missing files'
+
+        metadata_fastresume['libtorrent_resume']['files'].append({'priority':0 , 'mtime': mtime, 'completed':fchunks})
+    metadata_fastresume['libtorrent_resume']['uncertain_pieces.timestamp']=int(time.time())
+
+    if 'files' in metadata['info']:
+        content_path=os.path.join(content_path,str(metadata['info']['name'], "utf-8"))
+
+    metadata_fastresume['rtorrent']={
+    "state": 1,
+    "state_changed":int(time.time()),
+    "state_counter":1,
+    "chunks_wanted":0,
+    "chunks_done":chunks,
+    "complete":1,
+    "hashing":0,
+    "directory": content_path if os.path.isabs(content_path) else os.path.abspath(content_path),
+    "tied_to_file":outfile if os.path.isabs(outfile) else os.path.abspath(outfile),
+    "timestamp_finished":0,
+    "timestamp_started":int(time.time())
+    }
+
+    infohash=hashlib.sha1(data[entries['info'][1]:entries['info'][2]]).hexdigest()
+    if not v2_only:
+        print('infohash='+infohash)
+    if 'file tree' in metadata['info']:
+        print('infohash (v2)='+hashlib.sha256(data[entries['info'][1]:entries['info'][2]]).hexdigest())
+    if v2_only and partial:
+        print('Partial resume data needs v1 pieces, verifying everything instead')
+        partial=False
+
+    if verify_hashes or partial:
+        print('Verifying hashes...')
+        jobs=max(1, jobs)
+        offsets=file_offsets(lengths)
+        indexes=None
+        verified=set()
+        # pieces touching a missing file are bad without reading anything
+        skipped=set(itertools.chain.from_iterable(file_pieces(offsets, lengths, psize, i) for i in missing))
+        if cache:
+            cache_db=open_cache(cache)
+            identities=[None if i in missing or file in pads else file_identity(file) for i, file in enumerate(files)]
+            verified=cached_files(cache_db, identities, psize, infohash, offsets)
+            print(str(len(verified))+' of '+str(len(files))+' files already verified (cache)')
+        if cache or missing:
+            # only pieces touching a file that is not in the cache need hashing
+            # (padding only ever shares pieces with the file it pads)
+            indexes=sorted(set(itertools.chain.from_iterable(file_pieces(offsets, lengths, psize, i) for i in range(len(files)) if i not in verified and files[i] not in pads))-skipped)
+            # nothing cached or missing after all: read everything front to back
+            if indexes == list(range(chunks)):
+                indexes=None
+        # a sample is never enough for a partial bitfield
+        sample=verify_hashes == 'sample' and not partial and not v2_only
+        use_v2=v2_only or ('file tree' in metadata['info'] and not sample and not partial)
+        if use_v2:
+            if verify_hashes == 'sample':
+                print('Sampling needs v1 pieces, verifying everything instead')
+            failed_files, checked_files=verify_v2(files, lengths, roots, layers, psize, jobs, report, [i for i in range(len(files)) if roots[i] is not None and i not in verified], stats)
+            if cache:
+                cache_files(cache_db, files, identities, psize, infohash, offsets, [i for i in checked_files if i not in failed_files])
+                cache_db.close()
+            success=not failed_files
+            if report:
+                for i in sorted(failed_files):
+                    for index in failed_files[i]:
+                        print('Piece '+str(index)+' of '+files[i]+' FAILED')
+                        print('  '+files[i]+' bytes '+str(index*psize)+'-'+str(min((index+1)*psize, lengths[i])-1))
+            print('Passed!' if success else 'FAILED', end='\n\n')
+            if not success:
+                print('Exiting without generating fastresume file...')
+                return 'hash failure'
+        else:
+            if sample:
+                needed=None if indexes is None else set(indexes)
+                indexes=[index for index in sample_pieces(offsets, lengths, psize, chunks, sample_fraction, infohash) if needed is None or index in needed]
+                print('Sampling '+str(len(indexes))+' of '+str(chunks)+' pieces')
+            pieces_to_hash=pieces_generator(files, psize, jobs*2, lengths, indexes, pads, stats, not sample)
+            hashed_pieces = hash_pieces(pieces_to_hash, jobs, jobs*2, stats)
+            failed, checked=verify_pieces(hashed_pieces, metadata['info']['pieces'], report or partial, indexes)
+            if sample:
+                # padding files are never read, they do not count
+                sampled_files=set()
+                sampled_bytes=0
+                for index in indexes[:checked]:
+                    for file, start, end in piece_files(files, lengths, psize, index, offsets):
+                        if file not in pads:
+                            sampled_files.add(file)
+                            sampled_bytes+=end-start
+                real_files=[i for i, file in enumerate(files) if file not in pads]
+                real_size=sum(lengths[i] for i in real_files)
+                cached=sum(1 for i in real_files if i in verified)
+                print('Sample coverage: '+str(checked)+' of '+str(chunks)+' pieces, '+str(len(sampled_files))+' of '+str(len(real_files))+' files'+(' ('+str(cached)+' more files from cache)' if cached else '')+', '+str(sampled_bytes)+' of '+str(real_size)+' bytes ('+format(100*sampled_bytes/max(real_size, 1), '.1f')+'%)')
+            if cache and not sample:
+                # a file is verified once all of its pieces were compared and passed
+                if indexes is None:
+                    last_checked=checked-1
+                elif checked:
+                    last_checked=indexes[checked-1]
+                else:
+                    last_checked=-1
+                failed_files=set(i for index in failed for i in range(len(files)) if index in file_pieces(offsets, lengths, psize, i))
+                newly_verified=[i for i in range(len(files)) if i not in verified and i not in failed_files and identities[i] is not None and lengths[i] > 0 and file_pieces(offsets, lengths, psize, i)[-1] <= last_checked and skipped.isdisjoint(file_pieces(offsets, lengths, psize, i))]
+                cache_files(cache_db, files, identities, psize, infohash, offsets, newly_verified)
+                cache_db.close()
+            success=not failed and not skipped
+            if report:
+                for index in failed:
+                    print('Piece '+str(index)+' FAILED')
+                    for file, start, end in piece_files(files, lengths, psize, index, offsets):
+                        print('  '+file+' bytes '+str(start)+'-'+str(end-1))
+            print('Passed!' if success else 'FAILED', end='\n\n')
+            if partial and not success:
+                bad=skipped.union(failed)
+                bitfield=bytearray((chunks+7)//8)
+                for index in range(chunks):
+                    if index not in bad:
+                        bitfield[index//8] |= 0x80 >> (index%8)
+                chunks_done=chunks-len(bad)
+                print(str(chunks_done)+' of '+str(chunks)+' pieces good, writing partial resume data')
+                metadata_fastresume['libtorrent_resume']['bitfield']=bytes(bitfield)
+                for i, file_resume in enumerate(metadata_fastresume['libtorrent_resume']['files']):
+                    completed=sum(1 for index in file_pieces(offsets, lengths, psize, i) if index not in bad)
+                    file_resume['completed']=completed
+                    # priority 0 is "off", files still missing pieces must be downloaded
+                    if completed < len(file_pieces(offsets, lengths, psize, i)):
+                        file_resume['priority']=1
+                metadata_fastresume['rtorrent']['chunks_done']=chunks_done
+                metadata_fastresume['rtorrent']['chunks_wanted']=chunks-chunks_done
+                metadata_fastresume['rtorrent']['complete']=0
+                status='partial'
+            elif not success:
+                print('Exiting without generating fastresume file...')
+                return 'hash failure'
+
+    if v2_only:
+        print('rtorrent cannot load v2-only torrents, no fastresume file written')
+        return 'v2 only'
+
+    start=time.perf_counter()
+    output=splice_torrent(data, entries, metadata_fastresume)
+    if stats is not None:
+        stats.timed('bencode encode', time.perf_counter()-start)
+    write_torrent(outfile, output)
+    return status
+
+# statuses for which resume data was written (an inconsistent piece count is
+# only a warning)
+SUCCESS=('ok', 'inconsistent pieces', 'partial')
+
+def batch_torrents(batch):
+    """
+    Lists the torrents to process in batch mode: every .torrent file in a
+    directory (e.g. an rtorrent session directory), or every non-empty line of a
+    manifest file.
+    """
+    if os.path.isdir(batch):
+        return sorted(os.path.join(batch, name) for name in os.listdir(batch) if name.endswith('.torrent'))
+    with open(batch, 'r') as manifest:
+        return [line.strip() for line in manifest if line.strip()]
+
+class PrefixedOutput:
+    """
+    Stands in for sys.stdout in batch mode: the lines printed by a thread that
+    set a prefix are written whole, each one prefixed with it, so the output of
+    torrents processed at the same time can be told apart.
+    """
+    def __init__(self, stream):
+        self.stream=stream
+        self.lock=threading.Lock()
+        self.local=threading.local()
+
+    def prefix(self, prefix):
+        self.local.prefix=prefix
+        self.local.pending=''
+
+    def write(self, text):
+        if getattr(self.local, 'prefix', None) is None:
+            return self.stream.write(text)
+        lines=(self.local.pending+text).split('\n')
+        self.local.pending=lines.pop()
+        if lines:
+            with self.lock:
+                self.stream.write(''.join(self.local.prefix+line+'\n' for line in lines))
+        return len(text)
+
+    def end(self):
+        if self.local.pending:
+            self.write('\n')
+        self.local.prefix=None
+
+    def flush(self):
+        self.stream.flush()
+
+def fastresume_batch(torrents, content_path, outdir, parallel=4, jobs=1, **kwargs):
+    """
+    Runs fastresume on a list of torrents, a bounded number of them at a time,
+    writing each output to outdir with the same file name as the source.
+    Torrents sharing a file name (e.g. listed from two session directories)
+    would write the same output, none of them is run.
+    The jobs hashing threads are shared out between the torrents running at
+    the same time, so memory stays at about 2*jobs pieces however many run.
+    Every line printed for a torrent starts with its file name.
+    Any extra keyword arguments are passed on to fastresume.
+    Returns:
+        list of (torrent, status) tuples, in the same order as torrents
+    """
+    names=collections.Counter(os.path.basename(torrent) for torrent in torrents)
+    for torrent in torrents:
+        if names[os.path.basename(torrent)] > 1:
+            print(torrent+': another torrent has the same file name, skipping')
+    parallel=max(1, min(parallel, len(torrents)))
+    kwargs['jobs']=max(1, jobs//parallel)
+    output=PrefixedOutput(sys.stdout)
+    def run(torrent):
+        if names[os.path.basename(torrent)] > 1:
+            return 'duplicate name'
+        output.prefix(os.path.basename(torrent)+': ')
+        try:
+            return fastresume(torrent, content_path, os.path.join(outdir, os.path.basename(torrent)), **kwargs)
+        except Exception as e:
+            print(str(e))
+            return 'error'
+        finally:
+            output.end()
+
+    sys.stdout=output
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=parallel) as executor:
+            return list(zip(torrents, executor.map(run, torrents)))
+    finally:
+        sys.stdout=output.stream
+
+def print_summary(results):
+    #file names are enough, unless several torrents share one
+    names=collections.Counter(os.path.basename(torrent) for torrent, status in results)
+    labels=[os.path.basename(torrent) if names[os.path.basename(torrent)] == 1 else torrent for torrent, status in results]
+    width=max([len('torrent')]+[len(label) for label in labels])
+    print('torrent'.ljust(width)+'  status')
+    for label, (torrent, status) in zip(labels, results):
+        print(label.ljust(width)+'  '+status)
+    print()
+    counts=collections.Counter(status for torrent, status in results)
+    print(', '.join(status+': '+str(count) for status, count in sorted(counts.items())))
+
+def output_stats(stats, stats_json):
+    if stats is None:
+        return
+    summary=stats.summary()
+    print_stats(summary)
+    if stats_json:
+        with open(stats_json[0], 'w') as json_file:
+            json.dump(summary, json_file, indent=2)
+
+def main():
+    parser = argparse.ArgumentParser(description='Append fastresume information to torrent.')
+    parser.add_argument('-i', '--infile', help='Original torrent file.', nargs=1, required=False)
+    parser.add_argument('-b', '--batch', help='Directory of torrents (e.g. an rtorrent session directory) or manifest file with one torrent per line to process in one go, instead of --infile. --outfile is then the output directory.', nargs=1, required=False)
+    parser.add_argument('-p', '--path', help='Path to the files contained in the torrent.', nargs=1, required=False)
+    parser.add_argument('-o', '--outfile', help='Output torrent file with fastresume data.', nargs=1, required=False)
+    parser.add_argument('-v', '--verify', help='Verify all hashes, or with --verify=sample only the first and last piece of every file plus a random --sample-fraction of the rest.', nargs='?', const='full', default=False, choices=['full', 'sample'], required=False)
+    parser.add_argument('--sample-fraction', help='Fraction of the remaining pieces checked at random with --verify=sample (default: 0.01).', type=float, default=0.01, required=False)
+    parser.add_argument('--report', help='When verifying, check every piece and list the failed ones with the files they cover, instead of stopping at the first failure.', action="store_true", default=False, required=False)
+    parser.add_argument('--partial', help='Write resume data with only the good pieces marked as done instead of failing on missing files or bad pieces (implies --verify).', action="store_true", default=False, required=False)
+    parser.add_argument('-j', '--jobs', help='Number of threads used to hash pieces when verifying, shared between the --parallel torrents in batch mode (default: number of cpus).', type=int, default=os.cpu_count() or 1, required=False)
+    parser.add_argument('--parallel', help='Number of torrents processed at the same time in batch mode.', type=int, default=4, required=False)
+    parser.add_argument('--cache', help='Verification cache file, so unchanged files are not hashed again (default: '+default_cache()+').', nargs=1, required=False)
+    parser.add_argument('--no-cache', help='Do not use the verification cache.', action="store_true", default=False, required=False)
+    parser.add_argument('--prune-cache', help='Delete the cache entries of files that no longer exist or have changed, and exit.', action="store_true", default=False, required=False)
+    parser.add_argument('--stats', help='Print bytes read, read and hash throughput, time blocked on I/O and hashing, and bencode timings.', action="store_true", default=False, required=False)
+    parser.add_argument('--stats-json', help='Also write the statistics to this file as JSON (implies --stats).', nargs=1, required=False)
+    parser.add_argument('-c', '--clobber', help='Overwrite target file if it already exists.', action="store_true", default=False, required=False)
+    parser.add_argument('-r', '--remove', help='Remove fastresume data.', action="store_true", default=False, required=False)
+    parser.add_argument('--verbose', help='Decodes and dumps the torrent information on screen.', action="store_true", default=False, required=False)
+    args=parser.parse_args()
+    cache=None if args.no_cache else (args.cache[0] if args.cache else default_cache())
+
+    if args.prune_cache:
+        if cache is None or not os.path.isfile(cache):
+            print('No cache file to prune.')
+            exit(0)
+        cache_db=open_cache(cache)
+        print('Pruned '+str(prune_cache(cache_db))+' stale cache entries.')
+        cache_db.close()
+        exit(0)
+
+    if (args.infile is None) == (args.batch is None):
+        parser.error('exactly one of --infile or --batch is required')
+    if args.path is None or args.outfile is None:
+        parser.error('the following arguments are required: -p/--path, -o/--outfile')
+    content_path=args.path[0]
+    outfile=args.outfile[0]
+    stats=Stats() if args.stats or args.stats_json else None
+    options={'stats':stats, 'verify_hashes':args.verify, 'report':args.report, 'jobs':args.jobs, 'clobber':args.clobber, 'remove':args.remove, 'verbose':args.verbose, 'cache':cache, 'partial':args.partial, 'sample_fraction':args.sample_fraction}
+
+    if args.batch:
+        if not os.path.isdir(outfile):
+            print('Output directory does not exist!')
+            exit(1)
+        results=fastresume_batch(batch_torrents(args.batch[0]), content_path, outfile, args.parallel, **options)
+        print_summary(results)
+        output_stats(stats, args.stats_json)
+        exit(0 if all(status in SUCCESS for torrent, status in results) else 1)
+
+    status=fastresume(args.infile[0], content_path, outfile, **options)
+    output_stats(stats, args.stats_json)
+    exit(0 if status in SUCCESS else 1)
+
+main()
@@ -8,6 +8,7 @@ import json
 import os
 import subprocess
 from glob import glob
+from itertools import groupby, chain
 from argparse import ArgumentParser as argparse
 import time
 
@@ -15,31 +16,135 @@ import time
 delim='\t'
 
 
-def ff_history(db_file):
-    #returns a dictionary with the parsed history entries and the starting and ending dates of the history file
+def timestamp_formatter():
+    #returns a function doing datetime.fromtimestamp(date).strftime('%Y-%m-%d %H:%M:%S') with the slow part cached:
+    #the local time is worked out once per 15 minutes (utc offsets and their changes are in quarter hours),
+    #the minutes and seconds are added to it, and the result checked on the last second of the quarter
+    cache={}
+    def format_timestamp(date):
+        second=int(date)
+        quarter=second-second%900
+        if quarter not in cache:
+            if len(cache) > 4096:
+                cache.clear()
+            start=datetime.fromtimestamp(quarter)
+            prefix, minute=start.strftime('%Y-%m-%d %H:'), start.minute
+            if start.second == 0 and minute%15 == 0 and datetime.fromtimestamp(quarter+899).strftime('%Y-%m-%d %H:%M:%S') == prefix+'%02d:59' % (minute+14):
+                cache[quarter]=(prefix, minute)
+            else:
+                cache[quarter]=None
+        if cache[quarter] is None:
+            return datetime.fromtimestamp(date).strftime('%Y-%m-%d %H:%M:%S')
+        prefix, minute=cache[quarter]
+        offset=second-quarter
+        return prefix+'%02d:%02d' % (minute+offset//60, offset%60)
+    return format_timestamp
+
+def ff_history(db_file, since=None, last_visit=None):
+    #yields the parsed history entries ordered by date, straight from the database cursor
+    #only visits not exported yet if since (latest visit_date, highest id) is given: newer ones, and older ones added
+    #since (firefox sync, imports), which have a higher id; last_visit (a list) gets the latest date and highest id seen
     if not os.path.isfile(db_file):
         raise Exception('DB file not found at path: {}'.format(db_file))
-    with sqlite3.connect('file:'+db_file+'?immutable=1', uri=True) as history_db:
+    history_db=sqlite3.connect('file:'+db_file+'?immutable=1', uri=True)
+    try:
         cursor=history_db.cursor()
-        cursor.execute("SELECT visit_date, url, title FROM moz_historyvisits JOIN moz_places ON moz_historyvisits.place_id=moz_places.id;")
-        history_raw=cursor.fetchall()
+        if since is None:
+            cursor.execute("SELECT visit_date, url, title, moz_historyvisits.id FROM moz_historyvisits JOIN moz_places ON moz_historyvisits.place_id=moz_places.id ORDER BY visit_date, url;")
+        else:
+            #both columns are indexed; visits at the last date already exported are skipped by id below
+            cursor.execute("SELECT visit_date, url, title, moz_historyvisits.id FROM moz_historyvisits JOIN moz_places ON moz_historyvisits.place_id=moz_places.id WHERE visit_date >= ? OR moz_historyvisits.id > ? ORDER BY visit_date, url;", since)
+        format_timestamp=timestamp_formatter()
+        for element in cursor:
+            if since is not None and element[0] <= since[0] and element[3] <= since[1]:
+                continue
+            if last_visit is not None:
+                last_visit[:]=[max(last_visit[0], element[0]), max(last_visit[1], element[3])] if last_visit else [element[0], element[3]]
+            date=element[0]/1000000 #to convert weird ff epoch to unix standard epoch
+            site=str(element[1])
+            title=str(element[2])
+            yield [date, format_timestamp(date), site.replace(delim, ' '), title.replace(delim, ' ')]
         cursor.close()
-    
-    history={}
-    for element in history_raw:
-        date=element[0]/1000000 #to convert weird ff epoch to unix standard epoch
-        date_hr=datetime.fromtimestamp(date).strftime('%Y-%m-%d %H:%M:%S')
-        year=date_hr[:4]
-        if year not in history:
-            history[year]={"history":[],"date_min":99999999999, "date_max":0}
-        if date<history[year]["date_min"]: 
-            history[year]["date_min"]=date
-        if date>history[year]["date_max"]: 
-            history[year]["date_max"]=date
-        site=str(element[1])
-        title=str(element[2]) #will have to replace delims later on output .replace(delim, ' ')
-        history[year]["history"].append([date, date_hr, site.replace(delim, ' '), title.replace(delim, ' ')])
-    return history
+    finally:
+        history_db.close()
+
+def history_files(backup_target, profile_name):
+    #returns a dictionary year: the history file of that year (the one ending last, if there are several)
+    files={}
+    for filename in glob(os.path.join(backup_target,profile_name+'.hist.'+'??????????????_??????????????.txt')):
+        date_min, date_max=filename[-33:-4].split('_')
+        if date_min[:4] not in files or date_max > files[date_min[:4]][-18:-4]:
+            files[date_min[:4]]=filename
+    return files
+
+def load_state(state_file):
+    if not os.path.isfile(state_file):
+        return None
+    with open(state_file,'r') as state:
+        return json.load(state)
+
+def save_state(state_file, last_visit):
+    with open(state_file+'.tmp','w') as state:
+        json.dump({"visit_date":last_visit[0], "visit_id":last_visit[1]}, state)
+    os.replace(state_file+'.tmp', state_file)
+
+def write_history(backup_target, profile_name, history_year):
+    #writes the entries of a year (already sorted) as they come, the file is named after its first and last date at the end
+    date_min=None
+    date_max=None
+    temp_filename=os.path.join(backup_target,profile_name+'.hist.tmp')
+    with open(temp_filename,'w') as tempfile:
+        for j in history_year:
+            if date_min is None:
+                date_min=j[0]
+            date_max=j[0]
+            tempfile.write('\t'.join(str(k) for k in j)+'\n')
+    if date_min is None:
+        os.remove(temp_filename)
+        return None
+    filename=os.path.join(backup_target,profile_name+'.hist.'+datetime.fromtimestamp(date_min).strftime('%Y%m%d%H%M%S')+'_'+datetime.fromtimestamp(date_max).strftime('%Y%m%d%H%M%S')+'.txt')
+    os.rename(temp_filename, filename)
+    return filename
+
+def history_end(hist_file):
+    #returns the date and the line of the last visit in a history file, without reading all of it
+    with open(hist_file,'rb') as old_hist:
+        old_hist.seek(max(0, os.path.getsize(hist_file)-65536))
+        tail=[line for line in old_hist.read().splitlines() if line.strip()]
+    last_line=tail[-1].decode('utf-8', 'replace')+'\n' if tail else ''
+    last_date=float(last_line.split('\t')[0]) if tail else 0
+    return last_date, last_line
+
+def append_history(hist_file, history_year):
+    #appends visits newer than the file to it and renames it to its new end date; returns the new name
+    last_date, last_line=history_end(hist_file)
+    date_max=None
+    with open(hist_file,'a') as old_hist:
+        for j in history_year:
+            line='\t'.join(str(k) for k in j)+'\n'
+            #an interrupted run may have appended them already
+            if j[0] > last_date or (j[0] == last_date and line != last_line):
+                old_hist.write(line)
+                date_max=j[0]
+    if date_max is None:
+        return hist_file
+    new_filename=hist_file[:-18]+datetime.fromtimestamp(int(date_max)).strftime('%Y%m%d%H%M%S')+'.txt'
+    if new_filename != hist_file:
+        os.rename(hist_file, new_filename)
+    return new_filename
+
+def merge_history(backup_target, profile_name, hist_file, history_year):
+    #merges visits older than the end of a history file (synced or imported after it was written) into it,
+    #the file is rewritten in order and renamed to its new first and last date; returns the new name
+    merged=sorted(com_hist(hist_file, history_year)[1], key=lambda k:(float(k[0]), k[2]))
+    temp_filename=os.path.join(backup_target,profile_name+'.hist.tmp')
+    with open(temp_filename,'w') as tempfile:
+        for j in merged:
+            tempfile.write('\t'.join(j))
+    filename=os.path.join(backup_target,profile_name+'.hist.'+datetime.fromtimestamp(float(merged[0][0])).strftime('%Y%m%d%H%M%S')+'_'+datetime.fromtimestamp(float(merged[-1][0])).strftime('%Y%m%d%H%M%S')+'.txt')
+    os.remove(hist_file)
+    os.rename(temp_filename, filename)
+    return filename
     
 def com_hist(hist_file, hist_year):
     clean_old=[]
@@ -134,12 +239,34 @@ def ff_tabs(session_file):
     return {"tabs":tabs, "session_date":session_date}
 
 
-def parse_places(db_file,backup_target,profile_name):
+def parse_places(db_file,backup_target,profile_name,full=False):
     if os.path.isfile(db_file):
         print("places.sqlite found! Parsing bookmarks and history...")
-        history=ff_history(db_file)
-        print('history parsed!')
-        for i in history.values():
+        state_file=os.path.join(backup_target,profile_name+'.hist.state.json')
+        state=None if full else load_state(state_file)
+        since=None if state is None else (state["visit_date"], state["visit_id"])
+        last_visit=[] if since is None else list(since)
+        existing=history_files(backup_target, profile_name)
+        #the visits come ordered by date, so each year is written in one go and only one file is open at a time
+        for year, history_year in groupby(ff_history(db_file, since, last_visit), key=lambda j: j[1][:4]):
+            if since is not None and year in existing:
+                first=next(history_year)
+                history_year=chain([first], history_year)
+                #appending needs the visits in order after the end of the file
+                if first[0] >= history_end(existing[year])[0]:
+                    print("Appending new history to "+existing[year])
+                    print(append_history(existing[year], history_year))
+                else:
+                    print("Merging older visits added since the last export into "+existing[year])
+                    print(merge_history(backup_target, profile_name, existing[year], history_year))
+                continue
+            if year not in existing:
+                print("No existing history file found; creating new history file")
+                print(write_history(backup_target, profile_name, history_year))
+                continue
+            #only comparing with an existing file needs the year in memory
+            history_year=list(history_year)
+            i={"history":history_year, "date_min":history_year[0][0], "date_max":history_year[-1][0]}
             base_filename=os.path.join(backup_target,profile_name+'.hist.'+datetime.fromtimestamp(i["date_min"]).strftime('%Y%m%d%H%M%S')+'_'+datetime.fromtimestamp(i["date_max"]).strftime('%Y%m%d%H%M%S'))
             glob_name=os.path.join(backup_target,profile_name+'.hist.'+datetime.fromtimestamp(i["date_min"]).strftime('%Y%m%d%H%M%S')+'_??????????????.txt')
             glob_name2=os.path.join(backup_target,profile_name+'.hist.'+'??????????????_'+datetime.fromtimestamp(i["date_max"]).strftime('%Y%m%d%H%M%S')+'.txt')
@@ -199,10 +326,10 @@ def parse_places(db_file,backup_target,profile_name):
                     print("No changes found")
             else:
                 print("No existing history file found; creating new history file")
-                merged=sorted(i["history"], key=lambda k:(k[0], k[2]))
-                with open(base_filename+'.txt','w') as tempfile:
-                    for j in merged:
-                        tempfile.write('\t'.join(str(k) for k in j)+'\n')
+                write_history(backup_target, profile_name, i["history"])
+        print('history parsed!')
+        if last_visit:
+            save_state(state_file, last_visit)
         print("history written!")
         bookmarks=ff_bookmarks(db_file)
         print('bookmarks parsed!')
@@ -256,6 +383,7 @@ parser.add_argument('--output', '-o', type=str, help="Path to output files")
 parser.add_argument('--single_profile', '-s', type=str, help="Path to single profile")
 parser.add_argument('--places', type=str, help="Direct path to places.sqlite")
 parser.add_argument('--session', type=str, help="Direct path to session file")
+parser.add_argument('--full', action="store_true", default=False, help="Compare the whole history with the existing files instead of exporting only the visits since the last run")
 
 arguments=parser.parse_args()
 if arguments.config_path!=None and arguments.all_profiles==True:
@@ -267,7 +395,7 @@ elif arguments.config_path!=None and arguments.profile_name!=None:
     backup_target=arguments.output
     db_file=os.path.join(config_path, profile_name, 'places.sqlite')
     if os.path.isfile(db_file):
-        parse_places(db_file, backup_target, profile_name)
+        parse_places(db_file, backup_target, profile_name, arguments.full)
     session_file=os.path.join(config_path, profile_name, 'sessionstore-backups','recovery.jsonlz4')
     if os.path.isfile(session_file):
         parse_session(session_file, backup_target, profile_name)
@@ -0,0 +1,107 @@
+#Mount topology helpers shared by mls.py and consolidate.py.
+#/proc/self/mountinfo is parsed once per process and mountpoints are resolved
+#in-process, instead of forking `stat -c %m` for every single path.
+import os
+import re
+import errno
+import xattr
+
+_mounts=None
+_mergerfs=None
+_devices={}
+_allpaths={}
+
+def unescape(field):
+    #mountinfo escapes spaces, tabs, newlines and backslashes as octal (\040...)
+    return re.sub(r'\\([0-7]{3})', lambda match: chr(int(match.group(1), 8)), field)
+
+def list_mounts():
+    """
+    Returns a dict of mountpoint: filesystem type for every mount in
+    /proc/self/mountinfo. Only read the first time, later calls reuse it.
+    """
+    global _mounts
+    if _mounts is None:
+        _mounts={}
+        with open('/proc/self/mountinfo','r') as mountinfo:
+            for line in mountinfo.read().splitlines():
+                #id parent major:minor root mountpoint options [optional...] - fstype source superoptions
+                fields=line.split(' ')
+                separator=fields.index('-')
+                _mounts[unescape(fields[4])]=fields[separator+1]
+    return _mounts
+
+def mount_device(mountpoint):
+    if mountpoint not in _devices:
+        _devices[mountpoint]=os.stat(mountpoint).st_dev
+    return _devices[mountpoint]
+
+def longest_prefix(path):
+    best='/'
+    for mountpoint in list_mounts():
+        if (path == mountpoint or path.startswith(mountpoint.rstrip('/')+'/')) and len(mountpoint) > len(best):
+            best=mountpoint
+    return best
+
+def find_mountpoint(path):
+    """
+    Same answer as `stat -c %m -- path`, without the fork: the longest mountpoint
+    prefix of the path, as long as it is really on the same device. If it is not
+    (symlinks in the path, or a mount missing from mountinfo) walk up the
+    parent directories until the device changes, like stat does.
+    """
+    absolute=os.path.abspath(path)
+    device=os.lstat(absolute).st_dev
+    mountpoint=longest_prefix(absolute)
+    try:
+        if mount_device(mountpoint) == device:
+            return mountpoint
+    except OSError:
+        pass
+    current=os.path.realpath(os.path.dirname(absolute)) if absolute != '/' else '/'
+    if os.stat(current).st_dev != device:
+        return absolute
+    while current != '/':
+        parent=os.path.dirname(current)
+        if os.stat(parent).st_dev != device:
+            break
+        current=parent
+    return current
+
+def list_mergerfs():
+    """
+    Returns a dict of mergerfs mountpoint: list of branches. The branches are
+    read from the .mergerfs control file the first time, later calls reuse them.
+    """
+    global _mergerfs
+    if _mergerfs is None:
+        sanitize=re.compile(r'=[^:]*')
+        _mergerfs={}
+        for point, fstype in list_mounts().items():
+            if fstype == 'fuse.mergerfs':
+                _mergerfs[point]=re.sub(sanitize,'',xattr.get(os.path.join(point,'.mergerfs'),'user.mergerfs.branches').decode('utf-8')).split(':')
+    return _mergerfs
+
+def branch_paths(absolute, mountpoint):
+    """
+    Finds the copies of a path (on the mergerfs mount at mountpoint) in the
+    branches. Asks mergerfs first: the user.mergerfs.allpaths xattr lists
+    them all in a single getxattr. If mergerfs does not answer (xattrs
+    disabled with xattr=nosys/noattr, or a symlink, whose xattrs would be the
+    target's) every branch is probed with a stat instead. A mount that does
+    not support the xattr is only asked once.
+    Returns:
+        list of the full paths in the branches, in branch order, and the
+        method used: 'xattr' or 'probe'
+    """
+    if _allpaths.get(mountpoint, True) and not os.path.islink(absolute):
+        try:
+            value=xattr.get(absolute, 'user.mergerfs.allpaths')
+            _allpaths[mountpoint]=True
+            return [os.fsdecode(path) for path in value.split(b'\0') if path], 'xattr'
+        except (IOError, OSError) as e:
+            if e.errno in (errno.ENOTSUP, errno.ENOSYS, errno.ENODATA):
+                _allpaths[mountpoint]=False
+    relative=os.path.relpath(absolute,start=mountpoint)
+    paths=[os.path.join(branch,relative) for branch in list_mergerfs()[mountpoint]]
+    return [path for path in paths if os.path.exists(path)], 'probe'
@@ -2,54 +2,592 @@
 import os
 import sys
 import argparse
-import subprocess
-import xattr
-import re
+from mergerfs import find_mountpoint, list_mergerfs, branch_paths, longest_prefix
+import collections
+import heapq
+import itertools
+import queue
+import threading
+import sqlite3
+import concurrent.futures
+import ctypes
+import ctypes.util
+import struct
+import select
+import io
+import json
+import base64
 
 RED='\033[0;31m'
 NC='\033[0m'
 
-def find_mountpoint(path):
-    mountpoint=subprocess.run(['stat', '-c', '%m', '--', path],stdout=subprocess.PIPE, shell=False, check=True).stdout.decode('utf8').replace('\n', '').replace('\r', '')
-    return mountpoint
-
-def list_mergerfs():
-    mergerfs=re.compile(r'^[^ ]* (.*) fuse\.mergerfs.*')
-    sanitize=re.compile(r'=[^:]*')
-    mountpoint={}
-    with open('/proc/mounts','r') as mounts:
-        for line in mounts.read().splitlines():
-            (point, match)=re.subn(mergerfs,'\g<1>',line)
-            if match==1:
-                mountpoint[point]=re.sub(sanitize,'',xattr.get(os.path.join(point,'.mergerfs'),'user.mergerfs.branches').decode('utf-8')).split(':')
-    return mountpoint
+def read_paths(stream, separator=b'\n', size=2**16):
+    """
+    Yields the paths in a binary stream one at a time, as they arrive, so a
+    whole `find` can be piped in without holding it in memory.
+    """
+    pending=b''
+    for block in iter(lambda: stream.read1(size), b''):
+        pending+=block
+        paths=pending.split(separator)
+        pending=paths.pop()
+        for path in paths:
+            if path:
+                yield os.fsdecode(path)
+    if pending:
+        yield os.fsdecode(pending)
+
+def walk_sorted(root, prefix=(), device=None):
+    """
+    Walks a branch directly with os.scandir, without crossing filesystems.
+    Yields (path components relative to root, is_dir) in sorted order, the
+    same order for every branch, so the listings of several branches can be
+    merged as they are produced.
+    """
+    if device is None:
+        device=os.stat(root).st_dev
+    for entry in sorted(os.scandir(root), key=lambda entry: entry.name):
+        components=prefix+(entry.name,)
+        is_dir=entry.is_dir(follow_symlinks=False)
+        yield components, is_dir
+        if is_dir and entry.stat(follow_symlinks=False).st_dev == device:
+            yield from walk_sorted(entry.path, components, device)
+
+def branch_listing(root, index, batch=1024, depth=16):
+    """
+    Runs walk_sorted in its own thread (every branch is a different disk, so
+    they are all read at the same time) and yields (components, index, is_dir).
+    At most depth batches are queued, memory stays flat however big the tree.
+    """
+    batches=queue.Queue(maxsize=depth)
+    def produce():
+        try:
+            items=[]
+            for components, is_dir in walk_sorted(root):
+                items.append((components, index, is_dir))
+                if len(items) >= batch:
+                    batches.put(items)
+                    items=[]
+            batches.put(items)
+            batches.put(None)
+        except OSError as e:
+            batches.put(e)
+    threading.Thread(target=produce, daemon=True).start()
+    while True:
+        items=batches.get()
+        if items is None:
+            return
+        if isinstance(items, Exception):
+            raise items
+        yield from items
+
+def recursive_duplicates(absolute, mountpoint, branches):
+    """
+    Walks the directory absolute in every branch at once and merges the sorted
+    listings.
+    Yields:
+        (absolute path, list of the copies in the branches, is_dir) for every
+        path found in more than one branch, as soon as it is found
+    """
+    relative=os.path.relpath(absolute,start=mountpoint)
+    roots=[os.path.normpath(os.path.join(branch,relative)) for branch in branches]
+    roots=[root for root in roots if os.path.isdir(root) and not os.path.islink(root)]
+    listings=[branch_listing(root, index) for index, root in enumerate(roots)]
+    for components, copies in itertools.groupby(heapq.merge(*listings), key=lambda item: item[0]):
+        copies=list(copies)
+        if len(copies) > 1:
+            yield os.path.join(absolute, *components), [os.path.join(roots[index], *components) for components, index, is_dir in copies], copies[0][2]
+
+def default_index():
+    return os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'mls', 'index.sqlite')
+
+def open_index(index_file):
+    """
+    Opens (creating it if needed) the index of the branches: one row per
+    entry with its parent directory and name (as bytes, names need not be
+    UTF-8), and the mtime of every directory when it was last listed.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(index_file)), exist_ok=True)
+    index_db=sqlite3.connect(index_file, timeout=60, check_same_thread=False)
+    index_db.execute("PRAGMA journal_mode=WAL")
+    #it is only a cache of the branches, losing the last commits to a power
+    #cut is fine, it is never corrupted in WAL mode
+    index_db.execute("PRAGMA synchronous=NORMAL")
+    index_db.execute("""
+    CREATE TABLE IF NOT EXISTS files (
+        branch TEXT, parent BLOB, name BLOB, size INTEGER, mtime INTEGER, inode INTEGER, is_dir INTEGER,
+        PRIMARY KEY (branch, parent, name)
+    );
+    """)
+    index_db.execute("CREATE INDEX IF NOT EXISTS files_path ON files (parent, name);")
+    index_db.execute("CREATE TABLE IF NOT EXISTS dirs (branch TEXT, path BLOB, mtime INTEGER, PRIMARY KEY (branch, path));")
+    index_db.commit()
+    return index_db
+
+def index_branch(index_db, lock, branch, batch=512):
+    """
+    Brings the index of a branch up to date. Every known directory is
+    stat'ed, but only those whose mtime changed (an entry was added, removed
+    or renamed) or that are new get listed again. Changes to files inside an
+    otherwise unchanged directory (a rewrite in place) are not picked up.
+    The listings are written batch directories per transaction, so the other
+    branches are not held up by one commit per directory.
+    Returns:
+        number of directories listed, number of directories checked
+    """
+    device=os.stat(branch).st_dev
+    with lock:
+        known=dict(index_db.execute("SELECT path, mtime FROM dirs WHERE branch=?;", (branch,)).fetchall())
+    children=collections.defaultdict(list)
+    for path in known:
+        if path:
+            children[os.path.dirname(path)].append(path)
+    seen=set()
+    listed=0
+    pending=[b'']
+    listings=[]
+    def write():
+        with lock:
+            with index_db:
+                for relative_dir, mtime, rows in listings:
+                    index_db.execute("DELETE FROM files WHERE branch=? AND parent=?;", (branch, relative_dir))
+                    index_db.executemany("INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?);", rows)
+                    index_db.execute("INSERT OR REPLACE INTO dirs VALUES (?, ?, ?);", (branch, relative_dir, mtime))
+        del listings[:]
+    while pending:
+        relative_dir=pending.pop()
+        try:
+            stat=os.stat(os.path.join(os.fsencode(branch), relative_dir))
+        except FileNotFoundError:
+            continue
+        if stat.st_dev != device:
+            continue
+        seen.add(relative_dir)
+        if known.get(relative_dir) == stat.st_mtime_ns:
+            pending.extend(children[relative_dir])
+            continue
+        rows=[]
+        for entry in os.scandir(os.path.join(os.fsencode(branch), relative_dir)):
+            entry_stat=entry.stat(follow_symlinks=False)
+            is_dir=entry.is_dir(follow_symlinks=False)
+            rows.append((branch, relative_dir, entry.name, entry_stat.st_size, entry_stat.st_mtime_ns, entry_stat.st_ino, int(is_dir)))
+            if is_dir and entry_stat.st_dev == device:
+                pending.append(os.path.join(relative_dir, entry.name))
+        listed+=1
+        listings.append((relative_dir, stat.st_mtime_ns, rows))
+        if len(listings) >= batch:
+            write()
+    write()
+    gone=[(branch, path) for path in known if path not in seen]
+    with lock:
+        with index_db:
+            index_db.executemany("DELETE FROM files WHERE branch=? AND parent=?;", gone)
+            index_db.executemany("DELETE FROM dirs WHERE branch=? AND path=?;", gone)
+    return listed, len(seen)
+
+def update_index(index_db, branches):
+    """
+    Refreshes the index of every branch at the same time, they are all
+    different disks.
+    """
+    lock=threading.Lock()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(branches))) as executor:
+        for branch, (listed, checked) in zip(branches, executor.map(lambda branch: index_branch(index_db, lock, branch), branches)):
+            print(branch+': '+str(listed)+' of '+str(checked)+' directories listed', file=sys.stderr)
+
+def indexed(index_db, branches):
+    return all(index_db.execute("SELECT 1 FROM dirs WHERE branch=? LIMIT 1;", (branch,)).fetchone() for branch in branches)
+
+def index_lookup(index_db, absolute, mountpoint, branches):
+    """
+    Index version of branch_paths.
+    Returns:
+        list of the copies of absolute in the branches, whether it is a
+        directory, and the (size, mtime, inode) of every copy
+    """
+    relative=os.fsencode(os.path.relpath(absolute,start=mountpoint))
+    found={row[0]: row[1:] for row in index_db.execute("SELECT branch, is_dir, size, mtime, inode FROM files WHERE parent=? AND name=?;", (os.path.dirname(relative), os.path.basename(relative)))}
+    copies=[branch for branch in branches if branch in found]
+    return [os.path.join(branch, os.fsdecode(relative)) for branch in copies], any(found[branch][0] for branch in copies), [found[branch][1:] for branch in copies]
+
+def index_duplicates(index_db, absolute, mountpoint, branches):
+    """
+    Index version of recursive_duplicates, answered by a single query.
+    Yields:
+        (absolute path, list of the copies in the branches, is_dir, list of
+        the (size, mtime, inode) of every copy) for every path under absolute
+        found in more than one branch
+    """
+    relative=os.fsencode(os.path.relpath(absolute,start=mountpoint))
+    if relative == b'.':
+        where, parameters="", ()
+    else:
+        #every parent under relative: relative itself, or between relative/ and relative0 ('0' follows '/')
+        where, parameters=" AND (parent=? OR (parent>=? AND parent<?))", (relative, relative+b'/', relative+b'0')
+    query="SELECT parent, name, max(is_dir), group_concat(branch||char(0)||size||char(0)||mtime||char(0)||inode, char(0)) FROM files WHERE branch IN ("+','.join('?'*len(branches))+")"+where+" GROUP BY parent, name HAVING count(*) > 1;"
+    for parent, name, is_dir, found in index_db.execute(query, tuple(branches)+parameters):
+        path=os.fsdecode(os.path.join(parent, name))
+        fields=found.split('\0')
+        found={fields[k]: (int(fields[k+1]), int(fields[k+2]), int(fields[k+3])) for k in range(0, len(fields), 4)}
+        copies=[branch for branch in branches if branch in found]
+        yield os.path.join(mountpoint, path), [os.path.join(branch, path) for branch in copies], bool(is_dir), [found[branch] for branch in copies]
+
+IN_MOVED_FROM=0x00000040
+IN_MOVED_TO=0x00000080
+IN_CREATE=0x00000100
+IN_DELETE=0x00000200
+IN_Q_OVERFLOW=0x00004000
+IN_IGNORED=0x00008000
+IN_ONLYDIR=0x01000000
+IN_ISDIR=0x40000000
+
+class Inotify:
+    """
+    Minimal inotify binding through ctypes (libc), for --watch.
+    """
+    def __init__(self):
+        self.libc=ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd=self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+
+    def add_watch(self, path, mask):
+        wd=self.libc.inotify_add_watch(self.fd, os.fsencode(path), ctypes.c_uint32(mask))
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno())+' (fs.inotify.max_user_watches?)', path)
+        return wd
+
+    def rm_watch(self, wd):
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self):
+        """
+        Yields (wd, mask, name) for the events available, blocks if none.
+        """
+        data=os.read(self.fd, 2**16)
+        offset=0
+        while offset < len(data):
+            wd, mask, cookie, length=struct.unpack_from('iIII', data, offset)
+            name=data[offset+16:offset+16+length].rstrip(b'\0')
+            offset+=16+length
+            yield wd, mask, os.fsdecode(name)
+
+class DuplicateWatch:
+    """
+    Keeps the map of relative path: branches holding it for a directory,
+    from a scan of every branch (not the mergerfs mount) kept up to date by
+    inotify watches on the branches. Every change costs a few dict
+    operations, however big the tree. notify(sign, absolute, copies, is_dir)
+    is called when a path gains ('+') or loses ('-') a copy while it is or
+    was in more than one branch.
+    Branches that do not hold the directory (yet) have their deepest parent
+    of it watched instead, so a copy created later (e.g. cloned there by the
+    create policy of mergerfs) is picked up as soon as it appears.
+    """
+    MASK=IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | IN_ONLYDIR
+
+    def __init__(self, absolute, branches, relative, notify):
+        self.absolute=absolute
+        self.branches=[os.path.normpath(branch) for branch in branches]
+        self.roots=[os.path.normpath(os.path.join(branch, relative)) for branch in self.branches]
+        self.notify=notify
+        self.devices=[None]*len(self.roots)
+        self.inotify=Inotify()
+        self.reset()
+        for index in range(len(self.roots)):
+            self.start(index, False)
+
+    def reset(self):
+        self.copies={}
+        self.contents=collections.defaultdict(set)
+        self.watches={}
+        self.wds={}
+        #watches on the parents of missing roots: wd: (index, name awaited)
+        self.waiting={}
+
+    def fileno(self):
+        return self.inotify.fd
+
+    def duplicates(self):
+        for relative, copies in self.copies.items():
+            if len(copies) > 1:
+                yield os.path.join(self.absolute, relative), [os.path.join(self.roots[index], relative) for index in sorted(copies)], any(copies.values())
+
+    def start(self, index, emit):
+        """
+        Scans the directory in branch index or, if the branch does not hold
+        it, watches the deepest parent it has for the next directory on the
+        way to it.
+        """
+        root=self.roots[index]
+        branch=self.branches[index]
+        while True:
+            if os.path.isdir(root) and not os.path.islink(root):
+                self.devices[index]=os.stat(root).st_dev
+                self.scan(index, '', emit)
+                return
+            parent=os.path.dirname(root)
+            while len(parent) >= len(branch) and not (os.path.isdir(parent) and not os.path.islink(parent)):
+                parent=os.path.dirname(parent)
+            if len(parent) < len(branch):
+                #the branch itself is missing
+                return
+            wd=self.inotify.add_watch(parent, IN_CREATE | IN_MOVED_TO | IN_ONLYDIR)
+            name=os.path.relpath(root, parent).split(os.sep)[0]
+            #it may have appeared before the watch was in place
+            if not os.path.lexists(os.path.join(parent, name)):
+                self.waiting[wd]=(index, name)
+                return
+            self.inotify.rm_watch(wd)
+
+    def scan(self, index, relative, emit):
+        #watch first, so nothing created during the listing is missed
+        wd=self.inotify.add_watch(os.path.join(self.roots[index], relative), self.MASK)
+        self.watches[wd]=(index, relative)
+        self.wds[(index, relative)]=wd
+        for entry in os.scandir(os.path.join(self.roots[index], relative)):
+            is_dir=entry.is_dir(follow_symlinks=False)
+            self.add(index, os.path.join(relative, entry.name), is_dir, emit)
+            if is_dir and entry.stat(follow_symlinks=False).st_dev == self.devices[index]:
+                self.scan(index, os.path.join(relative, entry.name), emit)
+
+    def add(self, index, relative, is_dir, emit=True):
+        before=dict(self.copies.get(relative, {}))
+        self.copies.setdefault(relative, {})[index]=is_dir
+        self.contents[(index, os.path.dirname(relative))].add(os.path.basename(relative))
+        if emit:
+            self.changed(relative, before)
+
+    def remove(self, index, relative):
+        if index not in self.copies.get(relative, {}):
+            return
+        before=dict(self.copies[relative])
+        is_dir=self.copies[relative].pop(index)
+        if not self.copies[relative]:
+            del self.copies[relative]
+        self.contents[(index, os.path.dirname(relative))].discard(os.path.basename(relative))
+        if is_dir:
+            #a directory moved away takes its whole subtree without an event for each
+            for name in list(self.contents.pop((index, relative), ())):
+                self.remove(index, os.path.join(relative, name))
+            wd=self.wds.pop((index, relative), None)
+            if wd is not None:
+                del self.watches[wd]
+                self.inotify.rm_watch(wd)
+        self.changed(relative, before)
+
+    def changed(self, relative, before):
+        after=self.copies.get(relative, {})
+        if set(before) != set(after) and (len(before) > 1 or len(after) > 1):
+            self.notify('+' if len(after) > len(before) else '-', os.path.join(self.absolute, relative), [os.path.join(self.roots[index], relative) for index in sorted(after)], any(after.values()) or any(before.values()))
+
+    def resync(self):
+        #events were lost: scan again and report the differences
+        old=self.copies
+        for wd in list(self.watches)+list(self.waiting):
+            self.inotify.rm_watch(wd)
+        self.reset()
+        for index in range(len(self.roots)):
+            self.start(index, False)
+        for relative in set(old) | set(self.copies):
+            self.changed(relative, old.get(relative, {}))
+
+    def handle(self):
+        for wd, mask, name in self.inotify.read():
+            if mask & IN_Q_OVERFLOW:
+                print('inotify queue overflow, rescanning '+self.absolute, file=sys.stderr)
+                self.resync()
+                return
+            if wd in self.waiting:
+                index, awaited=self.waiting[wd]
+                #the parent went away (IN_IGNORED) or the next directory appeared
+                if mask & IN_IGNORED or name == awaited:
+                    del self.waiting[wd]
+                    if not mask & IN_IGNORED:
+                        self.inotify.rm_watch(wd)
+                    self.start(index, True)
+                continue
+            if mask & IN_IGNORED:
+                #the directory itself was removed from a branch, wait for it again
+                if wd in self.watches and self.watches[wd][1] == '':
+                    index=self.watches.pop(wd)[0]
+                    del self.wds[(index, '')]
+                    self.contents.pop((index, ''), None)
+                    self.start(index, True)
+                continue
+            if wd not in self.watches:
+                continue
+            index, relative_dir=self.watches[wd]
+            relative=os.path.join(relative_dir, name)
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                self.add(index, relative, bool(mask & IN_ISDIR))
+                if mask & IN_ISDIR:
+                    try:
+                        if os.lstat(os.path.join(self.roots[index], relative)).st_dev == self.devices[index]:
+                            self.scan(index, relative, True)
+                    except FileNotFoundError:
+                        #already gone again, its delete event follows
+                        pass
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                self.remove(index, relative)
+
+def report(absolute, source, args):
+    if len(source) > 1 and args.quiet==False:
+        print(RED+absolute+'\t'+':'.join(source)+NC)
+    elif len(source) > 1 and args.quiet==True:
+        print(absolute+'\t'+':'.join(source))
+    elif args.quiet==False:
+        print(absolute.encode('utf-8', 'replace').decode()+'\t'+str(':'.join(source).encode('utf-8', 'replace').decode()))
+
+class Output:
+    """
+    Writes the results in the format chosen. text is the coloured output of
+    report() for humans. jsonl (one JSON object per line) and nul are for
+    programs: one record per path with the size, mtime (ns) and inode of
+    every copy, paths also given as raw bytes, through a buffered writer.
+    A nul record is NUL terminated fields: the event (watch only), the path,
+    then path, size, mtime, inode of every copy, and an empty field.
+    """
+    def __init__(self, args):
+        self.args=args
+        if args.format != 'text':
+            self.stream=io.BufferedWriter(io.FileIO(sys.stdout.fileno(), 'w', closefd=False), buffer_size=2**20)
+
+    def report(self, absolute, source, is_dir=None, metadata=None, sign=None):
+        args=self.args
+        if args.format == 'text':
+            if sign is None:
+                report(absolute, source, args)
+            elif args.quiet==False and sign == '+':
+                print(RED+sign+'\t'+absolute+'\t'+':'.join(source)+NC)
+            else:
+                print(sign+'\t'+absolute+'\t'+':'.join(source))
+            return
+        if sign is None and len(source) < 2 and args.quiet==True:
+            return
+        if metadata is None:
+            #live lookups only know the paths, indexed ones come with their metadata
+            metadata=[]
+            for path in source:
+                try:
+                    stat=os.lstat(path)
+                    metadata.append((stat.st_size, stat.st_mtime_ns, stat.st_ino))
+                except OSError:
+                    metadata.append((None, None, None))
+        if is_dir is None and source:
+            is_dir=os.path.isdir(source[0])
+        if args.format == 'jsonl':
+            record={'path': os.fsencode(absolute).decode('utf-8', 'replace'), 'path_bytes': base64.b64encode(os.fsencode(absolute)).decode('ascii'), 'is_dir': is_dir, 'copies': []}
+            if sign is not None:
+                record['event']=sign
+            for path, (size, mtime, inode) in zip(source, metadata):
+                record['copies'].append({'path': os.fsencode(path).decode('utf-8', 'replace'), 'path_bytes': base64.b64encode(os.fsencode(path)).decode('ascii'), 'size': size, 'mtime': mtime, 'inode': inode})
+            self.stream.write(json.dumps(record).encode('ascii')+b'\n')
+        else:
+            fields=([sign.encode('ascii')] if sign is not None else [])+[os.fsencode(absolute)]
+            for path, copy in zip(source, metadata):
+                fields+=[os.fsencode(path)]+[b'-' if value is None else str(value).encode('ascii') for value in copy]
+            self.stream.write(b'\0'.join(fields)+b'\0\0')
+
+    def flush(self):
+        if self.args.format != 'text':
+            self.stream.flush()
 
 def main():
     parser = argparse.ArgumentParser(description='Find mergerfs files present in multiple branches')
     parser.add_argument('-q','--quiet',help='Only outputs files present in multiple branches, no colour', action='store_true', default=False)
     parser.add_argument('-d','--directories',help='List only directories', action='store_true', default=False)
     parser.add_argument('-f','--files',help='List only files', action='store_true', default=False)
-    parser.add_argument('filenames', nargs='+', help='File or files to check')
+    parser.add_argument('--stdin',help='Also read the files to check from standard input, one per line', action='store_true', default=False)
+    parser.add_argument('-0','--null',help='With --stdin, the files are separated by NUL characters (find -print0)', action='store_true', default=False)
+    parser.add_argument('-r','--recursive',help='Check everything inside the given directories, walking all the branches at once; only files present in multiple branches are listed', action='store_true', default=False)
+    parser.add_argument('--index',help='Answer from the index instead of the branches, without waking the disks up', action='store_true', default=False)
+    parser.add_argument('--update-index',help='Build or refresh the index of the branches of the mounts of the given files (of every mergerfs mount if none given) and exit', action='store_true', default=False)
+    parser.add_argument('--index-file',help='Index file (default: '+default_index()+')', default=default_index())
+    parser.add_argument('--watch',help='Watch the given directories: list the paths already in multiple branches, then every path gaining (+) or losing (-) a copy while in multiple branches, until interrupted', action='store_true', default=False)
+    parser.add_argument('--format',help='Output format. text: coloured, for humans; jsonl: a JSON object per path; nul: NUL separated fields, an empty field ends each path. jsonl and nul give the size, mtime and inode of every copy', choices=['text', 'jsonl', 'nul'], default='text')
+    parser.add_argument('filenames', nargs='*', help='File or files to check')
     args=parser.parse_args()
-    
+    if not args.filenames and not args.stdin and not args.update_index:
+        parser.error('files are required unless --stdin is given')
+
+    filenames=args.filenames
+    if args.stdin:
+        filenames=itertools.chain(filenames, read_paths(sys.stdin.buffer, b'\0' if args.null else b'\n'))
     mergerfs=list_mergerfs()
-    for i in args.filenames:
+    output=Output(args)
+    if args.update_index:
+        mountpoints=set(longest_prefix(os.path.abspath(i)) for i in filenames) & set(mergerfs.keys()) or set(mergerfs.keys())
+        index_db=open_index(args.index_file)
+        update_index(index_db, [branch for mountpoint in sorted(mountpoints) for branch in mergerfs[mountpoint]])
+        index_db.close()
+        return
+    if args.index:
+        index_db=open_index(args.index_file)
+        for i in filenames:
+            #no stat through the mount, it would wake a disk up
+            absolute=os.path.abspath(os.path.normpath(i))
+            mountpoint=longest_prefix(absolute)
+            if str(mountpoint) not in mergerfs.keys():
+                continue
+            if not indexed(index_db, mergerfs[mountpoint]):
+                print(mountpoint+' is not indexed, run with --update-index first', file=sys.stderr)
+                continue
+            if args.recursive:
+                results=index_duplicates(index_db, absolute, mountpoint, mergerfs[mountpoint])
+            else:
+                results=[(absolute,)+index_lookup(index_db, absolute, mountpoint, mergerfs[mountpoint])]
+            for path, source, is_dir, metadata in results:
+                if (args.files==False and args.directories==False) or ( args.files==True and not is_dir ) or ( args.directories==True and is_dir ):
+                    output.report(path, source, is_dir, metadata)
+        output.flush()
+        index_db.close()
+        return
+    if args.watch:
+        def notify(sign, absolute, source, is_dir):
+            if (args.files==False and args.directories==False) or ( args.files==True and not is_dir ) or ( args.directories==True and is_dir ):
+                output.report(absolute, source, is_dir, sign=sign)
+        watches=[]
+        for i in filenames:
+            absolute=os.path.abspath(os.path.normpath(i))
+            mountpoint=find_mountpoint(absolute)
+            if os.path.isdir(absolute) and str(mountpoint) in mergerfs.keys():
+                relative=os.path.relpath(absolute,start=mountpoint)
+                watch=DuplicateWatch(absolute, mergerfs[mountpoint], relative, notify)
+                for path, source, is_dir in watch.duplicates():
+                    if (args.files==False and args.directories==False) or ( args.files==True and not is_dir ) or ( args.directories==True and is_dir ):
+                        output.report(path, source, is_dir)
+                watches.append(watch)
+        output.flush()
+        try:
+            while watches:
+                for watch in select.select(watches, [], [])[0]:
+                    watch.handle()
+                #events are rare, whoever reads them wants them now
+                output.flush()
+        except KeyboardInterrupt:
+            pass
+        return
+    methods=collections.Counter()
+    for i in filenames:
         target=os.path.normpath(i)
-        if (args.files==False and args.directories==False) or ( args.files==True and os.path.isfile(target) ) or ( args.directories==True and os.path.isdir(target)): 
+        if args.recursive:
+            absolute=os.path.abspath(target)
+            mountpoint=find_mountpoint(absolute)
+            if os.path.isdir(target) and str(mountpoint) in mergerfs.keys():
+                for path, source, is_dir in recursive_duplicates(absolute, mountpoint, mergerfs[mountpoint]):
+                    if (args.files==False and args.directories==False) or ( args.files==True and not is_dir ) or ( args.directories==True and is_dir ):
+                        output.report(path, source, is_dir)
+            continue
+        if (args.files==False and args.directories==False) or ( args.files==True and os.path.isfile(target) ) or ( args.directories==True and os.path.isdir(target)):
             absolute=os.path.abspath(target)
             mountpoint=find_mountpoint(absolute)
             if str(mountpoint) in mergerfs.keys():
-                relative=os.path.relpath(absolute,start=mountpoint)
-                source=[]
-                for branch in mergerfs[mountpoint]:
-                    path=os.path.join(branch,relative)
-                    if os.path.exists(path):
-                        source.append(path)
-                if len(source) > 1 and args.quiet==False:
-                    print(RED+absolute+'\t'+':'.join(source)+NC)
-                elif len(source) > 1 and args.quiet==True:
-                    print(absolute+'\t'+':'.join(source))
-                elif args.quiet==False:
-                    print(absolute.encode('utf-8', 'replace').decode()+'\t'+str(':'.join(source).encode('utf-8', 'replace').decode()))
+                source, method=branch_paths(absolute, mountpoint)
+                methods[method]+=1
+                output.report(absolute, source)
+    output.flush()
+    if args.quiet==False and methods:
+        print(str(methods['xattr'])+' paths looked up with user.mergerfs.allpaths, '+str(methods['probe'])+' by probing every branch', file=sys.stderr)
 
 main()